@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
+import base64
 import getpass
+import hashlib
 import os
 import pathlib
 import random
@@ -7,6 +9,7 @@ import socket
 import string
 import subprocess
 import sys
+import time
 import json
 from dataclasses import dataclass
 from typing import Self
@@ -40,7 +43,8 @@ class MinisignPasswd:
     @classmethod
     def create(cls) -> Self:
         if os.environ.get("RUN_DEPLOY_MINISIGN_PASSWD_PIPE", None):
-            return cls(passwd=sys.stdin.read().strip())
+            # Only the first line, `batch` reads its queries from the rest
+            return cls(passwd=sys.stdin.readline().strip())
 
         if os.path.exists(os.path.expanduser("~/.config/run-deploy/options/minisign_passwd")):
             return cls(passwd=getpass.getpass("Minisign Password: ").strip())
@@ -55,51 +59,189 @@ class MinisignPasswd:
 
 passwd = MinisignPasswd.create()
 
+remote_args = sys.argv[2:]
+if remote_args[:1] == ["batch"]:
+    queries = None
+    try:
+        queries = json.load(sys.stdin)
+    except json.JSONDecodeError:
+        pass
+    if not isinstance(queries, list):
+        error_and_exit(
+            "BATCH_QUERIES",
+            "`batch` reads a json list of queries from stdin"
+        )
+    remote_args += [
+        "--queries", base64.urlsafe_b64encode(json.dumps(queries, separators=(",", ":")).encode('utf-8')).decode('ascii')
+    ]
+
 key_ref = f"{getpass.getuser()}@{socket.gethostname()}"
 if os.path.exists(os.path.expanduser("~/.config/run-deploy/key_ref.txt")):
     key_ref = pathlib.Path(os.path.expanduser("~/.config/run-deploy/key_ref.txt")).read_text('utf-8').strip()
     key_validation(key_ref)
 
-token_ref = ''.join(random.choice(string.ascii_letters+string.digits) for x in range(64))
-token_file_name = f"/tmp/run-deploy-token-{token_ref}"
-pathlib.Path(token_file_name).write_bytes(os.urandom(2048))
+# Set by run-deploy-remote-toml, it holds the master connection and every scp and ssh of the run goes through it
+ssh_options = []
+if os.environ.get("RUN_DEPLOY_SSH_CONTROL_PATH", None):
+    ssh_options = ["-o", f"ControlPath={os.environ['RUN_DEPLOY_SSH_CONTROL_PATH']}", "-o", "ControlMaster=no"]
 
+# Seconds a signed token can be reused for, 0 signs a new token every call.
+# Set by run-deploy-remote-toml, with the image the session is limited to.
+session_ttl = 0
 try:
-    extra = []
-    if os.path.exists(os.path.expanduser("~/.config/run-deploy/minisign.key")):
-        extra += ['-s', os.path.expanduser("~/.config/run-deploy/minisign.key")]
-    subprocess.run([
-        "minisign", "-S",
-    ] + extra + [ "-m", token_file_name ], check=True, capture_output=True, input=passwd.passwdInput())
-except subprocess.CalledProcessError:
-    error_and_exit(
-        "MINISIGN",
-        f"Did you forget to setup minisign? Does it require a password? Did you use the correct password?"
-    )
-
-
-def clear_keys():
-    os.remove(token_file_name)
-    os.remove(f"{token_file_name}.minisig")
+    session_ttl = max(int(os.environ.get("RUN_DEPLOY_SESSION_TTL", "0")), 0)
+except ValueError:
+    error_and_exit("SESSION_TTL", "`RUN_DEPLOY_SESSION_TTL` must be a number of seconds")
+session_image = os.environ.get("RUN_DEPLOY_SESSION_IMAGE", "") or None
 
-try:
-    subprocess.run([
-        "scp", f"{token_file_name}.minisig", token_file_name, f"{ssh_address}:/tmp/run-deploy"
-    ], check=True, capture_output=True)
-    clear_keys()
-except subprocess.CalledProcessError:
-    clear_keys()
-    error_and_exit(
-        "SSH_KEY_VALIDATION",
-        f"Did you forget to put the SSH private key into the agent? =D"
-    )
-
-env_token = f"RUN_DEPLOY_TOKEN={token_ref}"
-env_key = f"RUN_DEPLOY_KEY='{key_ref}'"
+# A session this close to expiring is not reused
+session_margin = 10
+
+session_marker = b"run-deploy-session\n"
+session_not_found = b'{\n\t"error_name": "SESSION_NOT_FOUND"'
+
+
+def session_cache_path() -> str:
+    digest = hashlib.sha256(f"{ssh_address}\n{key_ref}\n{session_image}".encode('utf-8')).hexdigest()
+    return os.path.expanduser(f"~/.cache/run-deploy/session/{digest}.json")
+
+
+def load_cached_session() -> tuple[str, str]|None:
+    try:
+        with open(session_cache_path(), "r") as f:
+            cached = json.load(f)
+        if cached["expires"] - time.time() > session_margin:
+            return cached["token"], cached["secret"]
+        os.remove(session_cache_path())
+    except (OSError, json.JSONDecodeError, KeyError, TypeError):
+        pass
+    return None
+
+
+def forget_cached_session():
+    if os.path.exists(session_cache_path()):
+        os.remove(session_cache_path())
+
+
+def store_cached_session(token: str, secret: str, expires: float):
+    os.makedirs(os.path.dirname(session_cache_path()), mode=0o700, exist_ok=True)
+    fd = os.open(session_cache_path(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "w") as f:
+        json.dump({"token": token, "secret": secret, "expires": expires}, f)
+
+
+def create_token(secret: str) -> str:
+    token = ''.join(random.choice(string.ascii_letters+string.digits) for x in range(64))
+    token_file_name = f"/tmp/run-deploy-token-{token}"
+    expires = time.time() + session_ttl
+    if session_ttl:
+        # Only the hash of the secret goes into the token, the server then wants the secret itself on every call
+        proof = hashlib.sha256(secret.encode('utf-8')).hexdigest()
+        pathlib.Path(token_file_name).write_bytes(
+            session_marker + json.dumps({"expires": expires, "image": session_image, "proof": proof}).encode('utf-8')
+        )
+    else:
+        pathlib.Path(token_file_name).write_bytes(os.urandom(2048))
+
+    try:
+        extra = []
+        if os.path.exists(os.path.expanduser("~/.config/run-deploy/minisign.key")):
+            extra += ['-s', os.path.expanduser("~/.config/run-deploy/minisign.key")]
+        subprocess.run([
+            "minisign", "-S",
+        ] + extra + [ "-m", token_file_name ], check=True, capture_output=True, input=passwd.passwdInput())
+    except subprocess.CalledProcessError:
+        os.remove(token_file_name)
+        error_and_exit(
+            "MINISIGN",
+            f"Did you forget to setup minisign? Does it require a password? Did you use the correct password?"
+        )
+
+    def clear_keys():
+        os.remove(token_file_name)
+        os.remove(f"{token_file_name}.minisig")
+
+    try:
+        subprocess.run([
+            "scp"
+        ] + ssh_options + [
+            f"{token_file_name}.minisig", token_file_name, f"{ssh_address}:/tmp/run-deploy"
+        ], check=True, capture_output=True)
+        clear_keys()
+    except subprocess.CalledProcessError:
+        clear_keys()
+        error_and_exit(
+            "SSH_KEY_VALIDATION",
+            f"Did you forget to put the SSH private key into the agent? =D"
+        )
+
+    if session_ttl:
+        store_cached_session(token, secret, expires)
+    return token
+
+
+def remote_command(token: str) -> list:
+    # The token ref alone is no use to anyone, a session also needs the secret, which goes on stdin (`session_input`)
+    session_env = ["RUN_DEPLOY_SESSION_STDIN=1"] if session_ttl else []
+    return [
+        "ssh"
+    ] + ssh_options + [
+        ssh_address, "--", f"RUN_DEPLOY_TOKEN={token}", f"RUN_DEPLOY_KEY='{key_ref}'"
+    ] + session_env + [
+        "/opt/run-deploy/bin/run-deploy-socket", "cli"
+    ] + remote_args
+
+
+def session_input(secret: str) -> bytes|None:
+    if not session_ttl:
+        return None
+    return f"{secret}\n".encode('utf-8')
+
+
+def run_with_session(token: str, secret: str) -> int|None:
+    # Stderr is passed through as it comes, except while it could still be the server saying the session is gone,
+    # then it returns None so the call can be made again with a new token.
+    process = subprocess.Popen(remote_command(token), stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    process.stdin.write(session_input(secret))
+    process.stdin.close()
+    held = b""
+    passing = False
+    while chunk := process.stderr.read1(65536):
+        if passing:
+            sys.stderr.buffer.write(chunk)
+            sys.stderr.buffer.flush()
+            continue
+        held += chunk
+        if not (session_not_found.startswith(held) or held.startswith(session_not_found)):
+            sys.stderr.buffer.write(held)
+            sys.stderr.buffer.flush()
+            passing = True
+    code = process.wait()
+    if passing:
+        return code
+    if held.startswith(session_not_found):
+        return None
+    sys.stderr.buffer.write(held)
+    sys.stderr.buffer.flush()
+    return code
+
+
+cached_session = None
+if session_ttl:
+    cached_session = load_cached_session()
+if cached_session:
+    exit_code = run_with_session(*cached_session)
+    if exit_code is None:
+        forget_cached_session()
+    else:
+        exit(exit_code)
+
+session_secret = ''.join(random.SystemRandom().choice(string.ascii_letters+string.digits) for x in range(64))
+token_ref = create_token(session_secret)
 
 try:
-    subprocess.run([
-        "ssh", ssh_address, "--", env_token, env_key, "/opt/run-deploy/bin/run-deploy-socket", "cli"
-    ] + sys.argv[2:], check=True)
+    subprocess.run(remote_command(token_ref), check=True, input=session_input(session_secret))
 except subprocess.CalledProcessError as e:
-    exit(e.returncode)
\ No newline at end of file
+    if session_ttl:
+        forget_cached_session()
+    exit(e.returncode)
@@ -21,6 +21,10 @@ ssh_authorized_keys = []
 # Use uv
 uv = false
 
+# Keep `run-deploy-socket serve` resident instead of starting
+# `run-deploy-socket recv` on every request
+resident_socket = false
+
 # The format is TOML
 """.strip()
 
@@ -55,6 +59,8 @@ os.mkdir("opt/run-deploy/minisign")
 os.mkdir("opt/run-deploy/ssh")
 os.mkdir("opt/run-deploy/script/deploy")
 os.mkdir("opt/run-deploy/options")
+# Uploads for metal deploys, next to `image` so they are renamed into place
+os.mkdir("opt/run-deploy/staging")
 
 # Enable strict mode by default
 pathlib.Path("opt/run-deploy/options/strict").write_text("strict", 'utf-8')
@@ -101,6 +107,8 @@ ExecStart=/usr/bin/mkdir /tmp/run-deploy-queue
 [Install]
 WantedBy=multi-user.target""", "utf-8")
 
+resident_socket = toml_config.get("resident_socket", False)
+
 systemd_symlinks = []
 systemd_cmd = []
 systemd_paths = pathlib.Path("opt/run-deploy/systemd/system").glob("run-deploy-*")
@@ -109,7 +117,12 @@ for systemd_name in systemd_paths:
     systemd_symlinks.append(
         f"ln -s '/opt/run-deploy/systemd/system/{systemd_name}' '/etc/systemd/system/{systemd_name}'"
     )
-    if systemd_name.endswith(".timer") or systemd_name.endswith(".path") or systemd_name.endswith("touch.service"):
+    if resident_socket and systemd_name == "run-deploy-socket.path":
+        continue
+    if not resident_socket and systemd_name == "run-deploy-socket-serve.service":
+        continue
+    if systemd_name.endswith(".timer") or systemd_name.endswith(".path") or systemd_name.endswith("touch.service") \
+            or systemd_name.endswith("serve.service"):
         systemd_cmd.append(f"systemctl enable '{systemd_name}'")
         systemd_cmd.append(f"systemctl start '{systemd_name}'")
 systemd_symlinks = "\n".join(systemd_symlinks)
@@ -137,6 +150,10 @@ chmod 750 /home/{toml_config['deploy_user']}/.ssh
 cp /opt/run-deploy/ssh/authorized_keys /home/{toml_config['deploy_user']}/.ssh
 chown root:{toml_config['deploy_user']} /home/{toml_config['deploy_user']}/.ssh/authorized_keys
 
+# The deploy user uploads into the staging directory
+chown {toml_config['deploy_user']}:{toml_config['deploy_user']} /opt/run-deploy/staging
+chmod 700 /opt/run-deploy/staging
+
 # Setup system service
 {systemd_symlinks}
 {systemd_cmd}
@@ -17,4 +17,5 @@ os.makedirs("/opt/run-deploy/options", exist_ok=True)
 pathlib.Path("/opt/run-deploy/options/strict").write_text("strict", 'utf-8')
 
 shutil.copy("run-deploy.py", "/opt/run-deploy/bin/run-deploy")
-shutil.copy("run-deploy-cli.py", "/opt/run-deploy/bin/run-deploy-cli")
\ No newline at end of file
+shutil.copy("run-deploy-cli.py", "/opt/run-deploy/bin/run-deploy-cli")
+shutil.copy("run-deploy-squashfs.py", "/opt/run-deploy/bin/run-deploy-squashfs")
\ No newline at end of file
@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
+import contextlib
 import datetime
 import getpass
+import importlib.machinery
 import json
 import os.path
 import pathlib
 import shutil
 import socket
 import string
+import struct
 import subprocess
 import sys
 import time
+import types
 
 
 def error_and_exit(error_name: str, message: str):
@@ -53,30 +57,145 @@ if not image_name.endswith(".squashfs"):
 
 os.chdir(base_dir)
 
+# Seconds per step and the calls into incus, printed at the end to show where a deploy spends its time
+timings: dict[str, float] = {}
+incus_calls = 0
+
+
+@contextlib.contextmanager
+def record_timing(step: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = timings.get(step, 0.0) + time.perf_counter() - start
+
+
+def run_incus(args: list[str], **kwargs) -> subprocess.CompletedProcess:
+    global incus_calls
+    incus_calls += 1
+    return subprocess.run(["incus"] + args, **kwargs)
+
+
+def print_timings():
+    steps = ", ".join(f"{step} {seconds:.2f}s" for step, seconds in timings.items())
+    print(f"Timing: {steps}, {incus_calls} incus calls")
+
+
+# Written by run-deploy-image-toml after the end of the filesystem: the manifest as json, its length (>I) and this
+manifest_trailer_magic = b"RDMANIF1"
+# Largest trailer read, the length comes from the unverified image
+manifest_trailer_max = 1024 * 1024
+
+
+def read_manifest_trailer() -> dict | None:
+    # The manifest without opening the image, None when the image was built without one
+    try:
+        with open(image_name, "rb") as f:
+            f.seek(-12, os.SEEK_END)
+            (size,) = struct.unpack(">I", f.read(4))
+            if f.read(8) != manifest_trailer_magic or size > manifest_trailer_max:
+                return None
+            f.seek(-12 - size, os.SEEK_END)
+            manifest = json.loads(f.read(size).decode('utf-8'))
+    except (OSError, ValueError, struct.error):
+        return None
+    return manifest if isinstance(manifest, dict) else None
+
+
+# The container the trailer already showed to exist
+checked_incus = ""
+
+
+def check_manifest_trailer():
+    # Turn a deploy that would fail anyway away before the image is unpacked, `_deploy/push.json` still decides
+    global checked_incus
+    manifest = read_manifest_trailer()
+    if manifest is None:
+        return
+    try:
+        incus_name = manifest[socket.gethostname()]['incus-name'].strip()
+    except (KeyError, AttributeError, TypeError):
+        os.remove(image_name)
+        error_and_exit(
+            "MANIFEST_JSON",
+            "Manifest is not well-formed!"
+        )
+    file_name_validation(incus_name, "incus_name", True)
+    try:
+        run_incus(["exec", incus_name, "--", "echo", "test"], check=True, capture_output=True)
+    except subprocess.CalledProcessError:
+        os.remove(image_name)
+        error_and_exit(
+            "CONTAINER_NOT_EXIST",
+            f"Container '{incus_name}' does not exist"
+        )
+    checked_incus = incus_name
+
+
+with record_timing("check"):
+    check_manifest_trailer()
+
 mnt_point = f"/tmp/run-deploy-mount-{time.time()}"
 os.mkdir(mnt_point, 0o700)
 
-try:
-    subprocess.run(["squashfuse", image_name, mnt_point], check=True)
-except subprocess.CalledProcessError:
-    os.remove(image_name)
-    os.rmdir(mnt_point)
-    error_and_exit(
-        "MOUNT",
-        f"Unable to mount '{image_name}'!"
-    )
 
-if not os.path.exists(f"{mnt_point}/_deploy/push.json"):
+def extract_deploy_dir() -> bool:
+    # `_deploy` read straight out of the image, False when the built-in reader can't and squashfuse has to mount it
+    if os.path.exists("/opt/run-deploy/options/squashfuse"):
+        return False
+    reader_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "run-deploy-squashfs")
+    if not os.path.exists(reader_path):
+        # Not installed, next to the source
+        reader_path += ".py"
+    try:
+        loader = importlib.machinery.SourceFileLoader("run_deploy_squashfs", reader_path)
+        squashfs = types.ModuleType(loader.name)
+        loader.exec_module(squashfs)
+    except OSError:
+        return False
+    deploy_dir = image_name.removesuffix('.squashfs')
+    try:
+        with record_timing("extract"):
+            found = squashfs.extract_dir(image_name, "_deploy", deploy_dir)
+    except squashfs.SquashfsError:
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        return False
+    if found is None or not os.path.exists(f"{deploy_dir}/push.json"):
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        os.remove(image_name)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MANIFEST_NOT_EXIST",
+            "'_deploy/push.json' does not exist"
+        )
+    return True
+
+
+if not extract_deploy_dir():
+    try:
+        subprocess.run(["squashfuse", image_name, mnt_point], check=True)
+    except subprocess.CalledProcessError:
+        os.remove(image_name)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MOUNT",
+            f"Unable to mount '{image_name}'!"
+        )
+
+    if not os.path.exists(f"{mnt_point}/_deploy/push.json"):
+        subprocess.run(["umount", mnt_point])
+        os.remove(image_name)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MANIFEST_NOT_EXIST",
+            "'_deploy/push.json' does not exist"
+        )
+
+    with record_timing("extract"):
+        shutil.copytree(f"{mnt_point}/_deploy", image_name.removesuffix('.squashfs'))
     subprocess.run(["umount", mnt_point])
-    os.remove(image_name)
-    os.rmdir(mnt_point)
-    error_and_exit(
-        "MANIFEST_NOT_EXIST",
-        "'_deploy/push.json' does not exist"
-    )
 
-shutil.copytree(f"{mnt_point}/_deploy", image_name.removesuffix('.squashfs'))
-subprocess.run(["umount", mnt_point])
 if getpass.getuser() == "root":
     os.chown(image_name, 0, 0)
 os.rename(image_name, f"{image_name.removesuffix('.squashfs')}/{image_name}")
@@ -97,7 +216,7 @@ try:
     image_dir = data['image-dir'].strip()
     to_exec = data['exec'].strip()
     stamp = data.get("stamp", False)
-except (KeyError, json.JSONDecodeError):
+except (KeyError, json.JSONDecodeError, AttributeError):
     os.chdir('..')
     shutil.rmtree(f"{image_name.removesuffix('.squashfs')}")
     os.rmdir(mnt_point)
@@ -119,20 +238,16 @@ def clean_up():
     shutil.rmtree(cleanup_dir)
     os.rmdir(mnt_point)
 
-try:
-    subprocess.run([
-        "incus", "exec", incus_name, "--", "echo", "test"
-    ], check=True, capture_output=True)
-except subprocess.CalledProcessError:
-    error_and_exit(
-        "CONTAINER_NOT_EXIST",
-        f"Container '{incus_name}' does not exist"
-    )
 
-# Create directory if not exist
-subprocess.run([
-    "incus", "exec", incus_name, "--", "mkdir", "-p", f"/opt/run-deploy/image/{image_dir}"
-], capture_output=True)
+if incus_name != checked_incus:
+    try:
+        with record_timing("check"):
+            run_incus(["exec", incus_name, "--", "echo", "test"], check=True, capture_output=True)
+    except subprocess.CalledProcessError:
+        error_and_exit(
+            "CONTAINER_NOT_EXIST",
+            f"Container '{incus_name}' does not exist"
+        )
 
 image_name_dir = f"{image_name.removesuffix('.squashfs')}"
 
@@ -159,37 +274,32 @@ if not os.path.exists(to_exec):
         f"'{to_exec}' does not exist"
     )
 
-# Upload Image to Incus container
-subprocess.run([
-    "incus", "file", "push", "--uid", "0", "--gid", "0", image_name, f"{incus_name}/opt/run-deploy/image/{image_dir}/"
-], check=True)
-
 # Copy Exec (Enforce name convention)
 if to_exec != image_name.removesuffix('.squashfs'):
     shutil.copy(to_exec, image_name.removesuffix('.squashfs'))
-    subprocess.run([
-        "incus", "file", "push", "--uid", "0", "--gid", "0", image_name.removesuffix('.squashfs'), f"{incus_name}/opt/run-deploy/image/{image_dir}/"
-    ], check=True)
-else:
-    subprocess.run([
-        "incus", "file", "push", "--uid", "0", "--gid", "0", to_exec, f"{incus_name}/opt/run-deploy/image/{image_dir}/"
-    ], check=True)
 
 # Blame
 pathlib.Path(f"{image_name.removesuffix('.squashfs')}.blame").write_text(f"{getpass.getuser()}@{socket.gethostname()}", 'utf-8')
-subprocess.run([
-    "incus", "file", "push", "--uid", "0", "--gid", "0", f"{image_name.removesuffix('.squashfs')}.blame", f"{incus_name}/opt/run-deploy/image/{image_dir}/"
-], check=True)
+
+# Image, exec and blame in one push, the image dir is created along the way. Not `--recursive`, it can't set the owner.
+with record_timing("push"):
+    run_incus([
+        "file", "push", "--uid", "0", "--gid", "0", "--create-dirs", image_name, image_name.removesuffix('.squashfs'),
+        f"{image_name.removesuffix('.squashfs')}.blame", f"{incus_name}/opt/run-deploy/image/{image_dir}/"
+    ], check=True)
 
 clean_up()
 
 # Exec
 try:
-    subprocess.run([
-        "incus", "exec", incus_name, "--", f"/opt/run-deploy/image/{image_dir}/{image_name.removesuffix('.squashfs')}"
-    ], check=True)
+    with record_timing("activate"):
+        run_incus([
+            "exec", incus_name, "--", f"/opt/run-deploy/image/{image_dir}/{image_name.removesuffix('.squashfs')}"
+        ], check=True)
 except subprocess.CalledProcessError as e:
     error_and_exit(
         "EXEC_FAIL",
         f"Image script execution return error code {e.returncode}: {e.output.decode('utf-8')}"
     )
+
+print_timings()
@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 import argparse
+import base64
+import binascii
+import contextlib
+import fcntl
+import functools
+import hashlib
+import hmac
+import io
 import json
 import os.path
+import shutil
 import string
 import subprocess
 import sys
+import tempfile
+import time
 import tomllib
+import traceback
 from dataclasses import dataclass
-from typing import Self
+from typing import Callable, Self
 
 
 def error_and_exit(error_name: str, message: str):
@@ -33,33 +45,154 @@ def validate_token_ref(value: str):
         )
 
 
+session_dir = "/opt/run-deploy/session"
+
+# First line of a token asking for a session, the rest is json with `expires` (unix time), `image` (scope or null)
+# and `proof`, the sha256 of a secret only the client holds
+session_marker = b"run-deploy-session\n"
+
+# Longest a session can live in seconds whatever the client asks for, 0 turns sessions off,
+# override with `/opt/run-deploy/options/session-max-ttl`
+default_session_max_ttl = 3600
+
+
+def session_max_ttl() -> int:
+    try:
+        with open("/opt/run-deploy/options/session-max-ttl", "r") as f:
+            return max(int(f.read().strip()), 0)
+    except (OSError, ValueError):
+        return default_session_max_ttl
+
+
+def session_path(token_ref: str) -> str:
+    # Hashed, so the directory listing doesn't hand out usable token refs
+    return f"{session_dir}/{hashlib.sha256(token_ref.encode('utf-8')).hexdigest()}.json"
+
+
+def read_session_secret() -> str | None:
+    # On stdin, other processes of the deploy user can read the environment, argv and file names
+    if not os.environ.get("RUN_DEPLOY_SESSION_STDIN"):
+        return None
+    return sys.stdin.readline().strip() or None
+
+
+def session_proof(secret: str) -> str:
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+
+def load_session(token_ref: str, key_ref_value: str, secret: str | None) -> dict | None:
+    # Knowing the token ref is not enough, the caller must also hold the secret the session was signed for
+    if secret is None:
+        return None
+    try:
+        with open(session_path(token_ref), "r") as f:
+            session_data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if session_data.get("expires", 0) <= time.time():
+        try:
+            os.remove(session_path(token_ref))
+        except FileNotFoundError:
+            pass
+        return None
+    if session_data.get("key") != key_ref_value:
+        return None
+    if not hmac.compare_digest(str(session_data.get("proof", "")), session_proof(secret)):
+        return None
+    return session_data
+
+
+def store_session(token_ref: str, key_ref_value: str, content: bytes, secret: str | None) -> dict | None:
+    # Without the secret the token is used once, like any other
+    if not content.startswith(session_marker) or secret is None:
+        return None
+    max_ttl = session_max_ttl()
+    if not max_ttl:
+        return None
+    try:
+        request = json.loads(content[len(session_marker):])
+        expires = min(float(request["expires"]), time.time() + max_ttl)
+        image = request.get("image", None)
+        proof = str(request["proof"])
+    except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError, ValueError, AttributeError):
+        error_and_exit("SESSION_TOKEN", "Session token must be json with `expires`, `image` and `proof`")
+    if image is not None:
+        file_name_validation(image, "session image", True)
+    if not hmac.compare_digest(proof, session_proof(secret)):
+        error_and_exit("SESSION_TOKEN", "Session secret does not match the token")
+    session_data = {"key": key_ref_value, "expires": expires, "image": image, "proof": proof}
+
+    os.makedirs(session_dir, mode=0o700, exist_ok=True)
+    for name in os.listdir(session_dir):
+        try:
+            with open(f"{session_dir}/{name}", "r") as f:
+                if json.load(f).get("expires", 0) <= time.time():
+                    os.remove(f"{session_dir}/{name}")
+        except (OSError, json.JSONDecodeError):
+            pass
+    try:
+        fd = os.open(session_path(token_ref), os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    except FileExistsError:
+        error_and_exit("SESSION_EXISTS", "Session already exists for this token")
+    with open(fd, "w") as f:
+        json.dump(session_data, f)
+    return session_data
+
+
 token_path = ""
 minisign_public_key_path = ""
-try:
-    token_ref = os.environ['RUN_DEPLOY_TOKEN'].strip()
-    key_ref = os.environ['RUN_DEPLOY_KEY'].strip()
-    validate_token_ref(token_ref)
-    validate_key_ref(key_ref)
-
-    token_path = f"/tmp/run-deploy/run-deploy-token-{token_ref}"
-    minisign_public_key_path = f"/opt/run-deploy/minisign/{key_ref}.pub"
-except KeyError:
-    error_and_exit(
-        "TOKEN_KEY",
-        "Must have env `RUN_DEPLOY_TOKEN` and `RUN_DEPLOY_KEY`"
-    )
-
-try:
-    subprocess.run(["minisign", "-Vqm", token_path, "-p", minisign_public_key_path], check=True)
-    os.remove(token_path)
-    os.remove(f"{token_path}.minisig")
-except subprocess.CalledProcessError:
-    os.remove(token_path)
-    os.remove(f"{token_path}.minisig")
-    error_and_exit(
-        "INVALID_SIGNATURE_AUTH",
-        f"Invalid signature for '{token_path}'"
-    )
+key_ref = ""
+session = None
+
+
+def verify_token():
+    global token_path, minisign_public_key_path, key_ref, session
+    try:
+        token_ref = os.environ['RUN_DEPLOY_TOKEN'].strip()
+        key_ref = os.environ['RUN_DEPLOY_KEY'].strip()
+        validate_token_ref(token_ref)
+        validate_key_ref(key_ref)
+
+        token_path = f"/tmp/run-deploy/run-deploy-token-{token_ref}"
+        minisign_public_key_path = f"/opt/run-deploy/minisign/{key_ref}.pub"
+    except KeyError:
+        error_and_exit(
+            "TOKEN_KEY",
+            "Must have env `RUN_DEPLOY_TOKEN` and `RUN_DEPLOY_KEY`"
+        )
+
+    secret = read_session_secret()
+    session = load_session(token_ref, key_ref, secret)
+    if session:
+        return
+    if not os.path.exists(token_path):
+        error_and_exit(
+            "SESSION_NOT_FOUND",
+            f"No token or session for '{token_ref}', the session may have expired"
+        )
+
+    # Verified from a copy only root can reach, the deploy user could otherwise swap the token after it was checked
+    verify_dir = tempfile.mkdtemp(prefix="run-deploy-token-")
+    try:
+        shutil.copyfile(token_path, f"{verify_dir}/token")
+        shutil.copyfile(f"{token_path}.minisig", f"{verify_dir}/token.minisig")
+        os.remove(token_path)
+        os.remove(f"{token_path}.minisig")
+        subprocess.run(["minisign", "-Vqm", f"{verify_dir}/token", "-p", minisign_public_key_path], check=True)
+        with open(f"{verify_dir}/token", "rb") as f:
+            content = f.read()
+    except (subprocess.CalledProcessError, OSError):
+        for path in [token_path, f"{token_path}.minisig"]:
+            if os.path.exists(path):
+                os.remove(path)
+        error_and_exit(
+            "INVALID_SIGNATURE_AUTH",
+            f"Invalid signature for '{token_path}'"
+        )
+    finally:
+        shutil.rmtree(verify_dir, ignore_errors=True)
+    session = store_session(token_ref, key_ref, content, secret)
+
 
 parser = argparse.ArgumentParser(description='Queries and operate run-deploy system')
 
@@ -73,7 +206,10 @@ command_arg_list = ', '.join([
     'list-incus',
     'list-image',
     'list-exec',
-    'permission-json'
+    'permission-json',
+    'preflight',
+    'delta-basis',
+    'batch'
 ])
 parser.add_argument('command', help=f"Commands: {command_arg_list}")
 incus_flag_list = ', '.join([
@@ -84,7 +220,9 @@ incus_flag_list = ', '.join([
     'revert',
     'list-image',
     'list-exec',
-    'permission-json'
+    'permission-json',
+    'preflight',
+    'delta-basis'
 ])
 parser.add_argument('--incus', help=f"Required for: {incus_flag_list}")
 image_flag_list = ', '.join([
@@ -92,19 +230,23 @@ image_flag_list = ', '.join([
     'last-deploy-blame',
     'list-revision',
     'revert',
-    'permission-json'
+    'permission-json',
+    'preflight',
+    'delta-basis'
 ])
 parser.add_argument('--image', help=f"Required for: {image_flag_list}")
-parser.add_argument('--revision', help="Required for: revert")
+parser.add_argument('--revision', help="Required for: revert, delta-basis (the revision about to be uploaded)")
 parser.add_argument('--cmd', help="Required for: exec")
+parser.add_argument('--queries', help="Required for: batch (base64 of a json list of queries)")
+parser.add_argument('--upload', help="Used by: preflight, delta-basis, where the image gets uploaded to (default: /tmp/run-deploy)")
 
-args = parser.parse_args()
-
-arg_command = args.command
-flag_incus = args.incus
-flag_image = args.image
-flag_revision = args.revision
-flag_cmd = args.cmd
+arg_command = ""
+flag_incus = None
+flag_image = None
+flag_revision = None
+flag_cmd = None
+flag_queries = None
+flag_upload = None
 
 
 def file_name_validation(value: str, name: str, flag: bool=False):
@@ -156,10 +298,29 @@ def validate_input_revision():
     file_name_validation(flag_revision, "flag_revision", True)
 
 
+def lock_target(name: str) -> int:
+    os.makedirs("/opt/run-deploy/lock", exist_ok=True)
+    lock_fd = os.open(f"/opt/run-deploy/lock/{name}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    return lock_fd
+
+
 def get_image_path():
     return f"/opt/run-deploy/image/{flag_image}"
 
 
+@functools.cache
+def load_permission() -> dict:
+    # Read once per call, `batch` checks the permission of every query against it
+    if not os.path.exists(f"/opt/run-deploy/permission/{key_ref}.toml"):
+        return {}
+    try:
+        with open(f"/opt/run-deploy/permission/{key_ref}.toml", "rb") as f:
+            return tomllib.load(f)
+    except tomllib.TOMLDecodeError:
+        return {}
+
+
 @dataclass(frozen=True)
 class Permission:
     full: bool
@@ -170,14 +331,7 @@ class Permission:
     def create(cls) -> Self:
         if not os.path.exists("/opt/run-deploy/permission"):
             return cls(admin=True, full=True, read=True)
-        if not os.path.exists(f"/opt/run-deploy/permission/{key_ref}.toml"):
-            return cls(full=False, read=False)
-        permission = {}
-        try:
-            with open(f"/opt/run-deploy/permission/{key_ref}.toml", "rb") as f:
-                permission = tomllib.load(f)
-        except tomllib.TOMLDecodeError:
-            return cls(full=False, read=False)
+        permission = load_permission()
         if permission.get("admin", False):
             return cls(admin=True, full=True, read=True)
         if permission.get("banned", False):
@@ -297,10 +451,17 @@ command_dict["list-revision"] = command_list_revision
 def command_revert() -> str:
     validate_input_image_incus()
     validate_input_revision()
+    lock_target(f"incus.{flag_incus}.{flag_image}")
     image_path = get_image_path()
-    subprocess.run([
-        "incus", "exec", flag_incus, "--", f"{image_path}/{flag_revision}"
-    ], check=True)
+    try:
+        subprocess.run([
+            "incus", "exec", flag_incus, "--", f"{image_path}/{flag_revision}"
+        ], check=True)
+    except subprocess.CalledProcessError as e:
+        error_and_exit(
+            "EXEC_FAIL",
+            f"Image script execution return error code {e.returncode}"
+        )
     return ""
 
 
@@ -308,10 +469,12 @@ command_dict["revert"] = command_revert
 
 
 def command_list_incus() -> str:
-    subprocess.run([
+    # Captured rather than left on the inherited stdout, so it ends up in the right result of a `batch`
+    process = subprocess.run([
         "incus", "list", "-c", "n", "-f", "csv"
-    ])
-    return ""
+    ], capture_output=True)
+    print(process.stderr.decode('utf-8'), end="", file=sys.stderr)
+    return process.stdout.decode('utf-8').strip()
 
 
 command_dict["list-image"] = command_list_incus
@@ -357,12 +520,239 @@ def command_permission_json() -> str:
 
 command_dict["permission-json"] = command_permission_json
 
-try:
-    cmd_output = command_dict[arg_command]()
-    if cmd_output:
-        print(cmd_output)
-except KeyError:
-    error_and_exit(
-        "COMMAND_NOT_FOUND",
-        f"Command `{arg_command}` was not found!"
-    )
+
+def free_space(path: str) -> int:
+    # Bytes free on the filesystem the path is (or would be) on, the closest directory that exists is used
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def container_exists() -> bool:
+    return subprocess.run([
+        "incus", "info", flag_incus
+    ], capture_output=True).returncode == 0
+
+
+def command_preflight() -> str:
+    # Everything a deploy needs to know before uploading, in one call
+    validate_input_image_incus()
+    permission = Permission.create()
+    result = {"admin": permission.admin, "full": permission.full, "read": permission.read}
+    if not (permission.admin or permission.full or permission.read):
+        json.dump(result, sys.stdout, indent="\t")
+        return ""
+    result["container-exists"] = container_exists()
+    result["current-revision"] = None
+    result["revision-count"] = 0
+    result["free-space"] = {"upload": free_space(flag_upload or "/tmp/run-deploy"), "image": None}
+    if result["container-exists"]:
+        # One round trip into the container, a line each for the current revision, revision count and free bytes
+        image_path = get_image_path()
+        try:
+            lines = subprocess.run([
+                "incus", "exec", flag_incus, "--", "sh", "-c",
+                'if [ -e "$1/$2.squashfs" ]; then basename "$(realpath "$1/$2.squashfs")" .squashfs; else echo; fi; '
+                'ls -1 "$1" 2>/dev/null | grep -c "\\.blame$"; '
+                'd="$1"; while [ ! -d "$d" ]; do d="$(dirname "$d")"; done; stat -f -c "%a %S" "$d"',
+                "preflight", image_path, flag_image
+            ], capture_output=True, check=True).stdout.decode('utf-8').split("\n")
+        except subprocess.CalledProcessError:
+            error_and_exit(
+                "CONTAINER_NOT_EXIST",
+                f"Container '{flag_incus}' does not exist or is not running"
+            )
+        blocks, block_size = lines[2].split()
+        result["current-revision"] = lines[0] or None
+        result["revision-count"] = int(lines[1])
+        result["free-space"]["image"] = int(blocks) * int(block_size)
+    json.dump(result, sys.stdout, indent="\t")
+    return ""
+
+
+command_dict["preflight"] = command_preflight
+
+
+def write_basis(copy: Callable[[io.BufferedWriter], None]):
+    # The upload dir belongs to the deploy user, so everything goes through a descriptor of it rather than its path,
+    # and the file is only renamed into place once it is complete
+    # `--upload` comes from the deploy user, root only writes into the upload dirs it knows about
+    upload_dirs = ["/tmp/run-deploy"]
+    path = os.path.realpath(flag_upload or "/tmp/run-deploy")
+    if path not in [os.path.realpath(allowed_dir) for allowed_dir in upload_dirs]:
+        error_and_exit(
+            "DELTA_BASIS",
+            f"Upload directory must be one of: {', '.join(upload_dirs)}"
+        )
+    try:
+        dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except OSError:
+        error_and_exit(
+            "DELTA_BASIS",
+            "Upload directory does not exist or is a symlink"
+        )
+    try:
+        owner = os.fstat(dir_fd).st_uid
+        # The deploy user owns `/tmp/run-deploy.path`, the socket takes requests from it
+        deploy_uid = os.stat("/tmp/run-deploy.path").st_uid if os.path.exists("/tmp/run-deploy.path") else 0
+        if owner == 0 or owner != deploy_uid:
+            error_and_exit(
+                "DELTA_BASIS",
+                "Upload directory must belong to the deploy user"
+            )
+        partial_name = f".run-deploy-basis-{os.getpid()}-{time.time_ns()}"
+        fd = os.open(partial_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o644, dir_fd=dir_fd)
+        try:
+            with open(fd, "wb") as f:
+                copy(f)
+                os.fchown(f.fileno(), owner, -1)
+            os.rename(partial_name, f"{flag_revision}.squashfs", src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        except BaseException:
+            os.unlink(partial_name, dir_fd=dir_fd)
+            raise
+    finally:
+        os.close(dir_fd)
+
+
+def command_delta_basis() -> str:
+    # Copies the current revision to where the next one is about to be uploaded, for rsync to send only what changed
+    validate_input_image_incus()
+    validate_input_revision()
+    Permission.create().must_be_full()
+    try:
+        current = command_last_deploy()
+    except subprocess.CalledProcessError:
+        print("There isn't a last deploy", file=sys.stderr)
+        return ""
+
+    def copy(f: io.BufferedWriter):
+        subprocess.run([
+            "incus", "file", "pull", f"{flag_incus}{get_image_path()}/{current}.squashfs", "-"
+        ], stdout=f, check=True)
+
+    try:
+        write_basis(copy)
+    except subprocess.CalledProcessError:
+        error_and_exit(
+            "DELTA_BASIS",
+            f"Unable to copy `{current}` out of the container"
+        )
+    return current
+
+
+command_dict["delta-basis"] = command_delta_basis
+
+
+# Commands `batch` can run, the ones that only read
+batch_commands = [
+    'edition',
+    'last-deploy',
+    'last-deploy-blame',
+    'list-revision',
+    'list-incus',
+    'list-image',
+    'list-exec',
+    'permission-json'
+]
+
+
+def run_query(query: dict) -> dict:
+    global arg_command, flag_incus, flag_image
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            match query:
+                case {"command": str()} if all(type(query.get(key, "")) is str for key in ["incus", "image"]):
+                    pass
+                case _:
+                    error_and_exit(
+                        "BATCH_QUERY",
+                        "Query must have `command`, with `command`, `incus` and `image` as strings"
+                    )
+            arg_command = query["command"]
+            flag_incus = query.get("incus", None)
+            flag_image = query.get("image", None)
+            if arg_command not in batch_commands or arg_command not in command_dict:
+                error_and_exit(
+                    "BATCH_COMMAND",
+                    f"Command `{arg_command}` can't be used in batch"
+                )
+            check_session_scope()
+            cmd_output = command_dict[arg_command]()
+            if cmd_output:
+                print(cmd_output)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            # Same as the cli dying on it, but the other queries still run
+            traceback.print_exc()
+            code = 1
+    return {"query": query, "code": code, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+def command_batch():
+    if flag_queries is None:
+        error_and_exit(
+            "FLAG_VALIDATION",
+            f"'--queries' is required for command: {arg_command}"
+        )
+    try:
+        queries = json.loads(base64.urlsafe_b64decode(flag_queries))
+    except (binascii.Error, ValueError):
+        error_and_exit(
+            "BATCH_QUERIES",
+            "'--queries' must be base64 of a json list"
+        )
+    if not isinstance(queries, list):
+        error_and_exit(
+            "BATCH_QUERIES",
+            "'--queries' must be base64 of a json list"
+        )
+    json.dump([run_query(query) for query in queries], sys.stdout, indent="\t")
+
+
+command_dict["batch"] = command_batch
+
+
+def check_session_scope():
+    if session and session["image"] is not None and flag_image != session["image"]:
+        error_and_exit(
+            "SESSION_SCOPE",
+            f"Session is only for image `{session['image']}`"
+        )
+
+
+def main(argv: list | None = None):
+    global arg_command, flag_incus, flag_image, flag_revision, flag_cmd, flag_queries, flag_upload
+    verify_token()
+
+    args = parser.parse_args(argv)
+
+    arg_command = args.command
+    flag_incus = args.incus
+    flag_image = args.image
+    flag_revision = args.revision
+    flag_cmd = args.cmd
+    flag_queries = args.queries
+    flag_upload = args.upload
+
+    # Every query of a batch is checked on its own
+    if arg_command != "batch":
+        check_session_scope()
+
+    try:
+        cmd_output = command_dict[arg_command]()
+        if cmd_output:
+            print(cmd_output)
+    except KeyError:
+        error_and_exit(
+            "COMMAND_NOT_FOUND",
+            f"Command `{arg_command}` was not found!"
+        )
+
+
+if __name__ == "__main__":
+    main()
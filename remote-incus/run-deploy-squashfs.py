@@ -0,0 +1 @@
+../remote-metal/run-deploy-squashfs.py
\ No newline at end of file
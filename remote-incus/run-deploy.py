@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
+import atexit
+import base64
+import contextlib
 import datetime
+import fcntl
 import getpass
+import importlib.machinery
 import json
 import os.path
 import pathlib
 import shutil
 import socket
 import string
+import struct
 import subprocess
 import sys
+import tempfile
 import time
 import tomllib
+import types
 from dataclasses import dataclass
 from typing import Self
 
@@ -31,14 +39,24 @@ def validate_key_ref(value: str):
 
 base_dir = ""
 image_name = ""
+# Put the image in place without executing it, prints the revision for `run-deploy-cli revert` to activate
+stage = False
+# Containers picked with `--incus`, out of the ones in the manifest, all of them when none is given
+incus_filter = []
 minisign_public_key_path = ""
+# Streamed in by `run-deploy-socket deploy-stream`, which checked the signature while the bytes arrived
+verified = False
 key_ref = ""
 try:
     target_path = sys.argv[1].strip()
     key_ref = sys.argv[2].strip()
     validate_key_ref(key_ref)
+    stage = "--stage" in sys.argv[3:]
+    incus_filter = [sys.argv[i + 1].strip() for i in range(3, len(sys.argv) - 1) if sys.argv[i] == "--incus"]
 
     base_dir = os.path.dirname(target_path)
+    # Only for images in the root-only stream directory, the socket is the one writing there
+    verified = "--verified" in sys.argv[3:] and os.path.dirname(os.path.realpath(base_dir)) == "/opt/run-deploy/stream"
     image_name = os.path.basename(target_path)
     minisign_public_key_path = f"/opt/run-deploy/minisign/{key_ref}.pub"
 except IndexError:
@@ -70,82 +88,76 @@ if not image_name.endswith(".squashfs"):
 
 os.chdir(base_dir)
 
-try:
-    subprocess.run(["minisign", "-Vqm", image_name, "-p", minisign_public_key_path], check=True)
-    os.remove(f"{image_name}.minisig")
-except subprocess.CalledProcessError:
+# Seconds per step and the calls into incus, printed at the end to show where a deploy spends its time
+timings: dict[str, float] = {}
+incus_calls = 0
+
+
+@contextlib.contextmanager
+def record_timing(step: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = timings.get(step, 0.0) + time.perf_counter() - start
+
+
+def run_incus(args: list[str], **kwargs) -> subprocess.CompletedProcess:
+    global incus_calls
+    incus_calls += 1
+    return subprocess.run(["incus"] + args, **kwargs)
+
+
+def print_timings():
+    steps = ", ".join(f"{step} {seconds:.2f}s" for step, seconds in timings.items())
+    print(f"Timing: {steps}, {incus_calls} incus calls")
+
+
+# Bytes of the image read by this deploy, printed at the end to show it was read once
+image_bytes_read = 0
+
+# Written by run-deploy-image-toml after the end of the filesystem: the manifest as json, its length (>I) and this
+manifest_trailer_magic = b"RDMANIF1"
+# Bytes kept from the end of the image to check the trailer against `_deploy/push.json`
+manifest_trailer_max = 1024 * 1024
+
+
+def parse_manifest_trailer(data: bytes) -> dict | None:
+    # From the last bytes of the image, None when the image was built without one
+    if len(data) < 12 or data[-8:] != manifest_trailer_magic:
+        return None
+    (size,) = struct.unpack(">I", data[-12:-8])
+    if size > len(data) - 12:
+        return None
+    try:
+        manifest = json.loads(data[-12 - size:-12].decode('utf-8'))
+    except ValueError:
+        return None
+    return manifest if isinstance(manifest, dict) else None
+
+
+def read_manifest_trailer() -> dict | None:
+    # The manifest without opening the image
+    global image_bytes_read
+    try:
+        with open(image_name, "rb") as f:
+            f.seek(-12, os.SEEK_END)
+            footer = f.read(12)
+            (size,) = struct.unpack(">I", footer[:4])
+            if footer[-8:] != manifest_trailer_magic or size > manifest_trailer_max:
+                return None
+            f.seek(-12 - size, os.SEEK_END)
+            data = f.read(size) + footer
+    except (OSError, struct.error):
+        return None
+    image_bytes_read += len(data)
+    return parse_manifest_trailer(data)
+
+
+def reject_early(error_name: str, message: str):
     os.remove(image_name)
-    os.remove(f"{image_name}.minisig")
-    error_and_exit(
-        "INVALID_SIGNATURE_AUTH",
-        f"Invalid signature for '{image_name}'"
-    )
-
-mnt_point = f"/tmp/run-deploy-mount-{time.time()}"
-os.mkdir(mnt_point, 0o700)
-
-try:
-    subprocess.run(["squashfuse", image_name, mnt_point], check=True)
-except subprocess.CalledProcessError:
-    os.remove(image_name)
-    os.rmdir(mnt_point)
-    error_and_exit(
-        "MOUNT",
-        f"Unable to mount '{image_name}'!"
-    )
-
-if not os.path.exists(f"{mnt_point}/_deploy/push.json"):
-    subprocess.run(["umount", mnt_point])
-    os.remove(image_name)
-    os.rmdir(mnt_point)
-    error_and_exit(
-        "MANIFEST_NOT_EXIST",
-        "'_deploy/push.json' does not exist"
-    )
-
-shutil.copytree(f"{mnt_point}/_deploy", image_name.removesuffix('.squashfs'))
-subprocess.run(["umount", mnt_point])
-if getpass.getuser() == "root":
-    os.chown(image_name, 0, 0)
-shutil.move(image_name, f"{image_name.removesuffix('.squashfs')}/{image_name}")
-
-os.chdir(image_name.removesuffix('.squashfs'))
-
-incus_name = ""
-image_dir = ""
-to_exec = ""
-stamp = False
-try:
-    data = {}
-    with open("push.json", "r", encoding='utf-8') as f:
-        data = json.load(f)
-
-    data = data[socket.gethostname()]
-    incus_name = data['incus-name'].strip()
-    image_dir = data['image-dir'].strip()
-    to_exec = data['exec'].strip()
-    stamp = data.get("stamp", False)
-except (KeyError, json.JSONDecodeError):
-    os.chdir('..')
-    shutil.rmtree(f"{image_name.removesuffix('.squashfs')}")
-    os.rmdir(mnt_point)
-    error_and_exit(
-        "MANIFEST_JSON",
-        "Manifest is not well-formed!"
-    )
-
-# Sanity check
-file_name_validation(incus_name, "incus_name", True)
-file_name_validation(to_exec, "to_exec")
-file_name_validation(image_dir, "image_dir", True)
-
-cleanup_dir = f"{image_name.removesuffix('.squashfs')}"
-
-
-def clean_up():
-    os.chdir('..')
-    shutil.rmtree(cleanup_dir)
-    os.rmdir(mnt_point)
+    pathlib.Path(f"{image_name}.minisig").unlink(missing_ok=True)
+    error_and_exit(error_name, message)
 
 
 @dataclass(frozen=True)
@@ -201,22 +213,315 @@ class Permission:
             )
 
 
-Permission.create().must_be_full()
+# Containers and image dir the trailer names, the image can go into them while minisign checks it
+trailer_incus_names = []
+trailer_image_dir = ""
+
+
+def check_manifest_trailer():
+    # Turn a deploy this server would refuse anyway away before minisign reads the whole image and it is unpacked.
+    # The trailer isn't verified yet so it only ever rejects, `_deploy/push.json` decides once the signature checks out.
+    global incus_name, image_dir, trailer_image_dir
+    manifest = read_manifest_trailer()
+    if manifest is None:
+        return
+    try:
+        data = manifest[socket.gethostname()]
+        names = data['incus-name']
+        if isinstance(names, str):
+            names = [names]
+        names = [name.strip() for name in names]
+        image_dir = data['image-dir'].strip()
+    except (KeyError, AttributeError, TypeError):
+        reject_early(
+            "MANIFEST_JSON",
+            "Manifest is not well-formed!"
+        )
+    file_name_validation(image_dir, "image_dir", True)
+    for incus_name in sorted(names):
+        if incus_filter and incus_name not in incus_filter:
+            continue
+        file_name_validation(incus_name, "incus_name", True)
+        if not Permission.create().full:
+            reject_early(
+                "PERMISSION",
+                f"You don't have full permission for deploy.( container: {incus_name}, image: {image_dir} )"
+            )
+        trailer_incus_names.append(incus_name)
+    trailer_image_dir = image_dir
+
+
+with record_timing("check"):
+    check_manifest_trailer()
+
+signature_path = os.path.abspath(f"{image_name}.minisig")
+def verify_signature():
+    global image_bytes_read
+    try:
+        with record_timing("verify"):
+            subprocess.run(["minisign", "-Vqm", image_name, "-x", signature_path, "-p", minisign_public_key_path],
+                           check=True)
+        os.remove(signature_path)
+    except subprocess.CalledProcessError:
+        reject_early(
+            "INVALID_SIGNATURE_AUTH",
+            f"Invalid signature for '{image_name}'"
+        )
+    image_bytes_read += os.path.getsize(image_name)
+
+
+def minisig_prehashed() -> bool:
+    # minisign reads the file of a prehashed (`ED`) signature front to back, so it can check it from a pipe. The legacy
+    # `Ed` needs the whole file.
+    try:
+        return base64.b64decode(pathlib.Path(signature_path).read_text('utf-8').splitlines()[1])[:2] == b"ED"
+    except (OSError, IndexError, ValueError):
+        return False
+
+
+# Image bytes read and handed on at a time
+ingest_chunk_size = 1024 * 1024
+
+image_size = 0
+# Pushed under a name of its own and renamed into place by the activation, an image that doesn't make it that far never
+# shows up as a revision
+pushed_name = f".{image_name}.{os.getpid()}.push"
+pushed_dir = ""
+# Containers holding the pushed image, it is deleted from them again when the deploy ends before activating it
+pushed_to: list[str] = []
+
+
+def discard_pushed():
+    for incus_name in pushed_to:
+        run_incus(["file", "delete", f"{incus_name}/opt/run-deploy/image/{pushed_dir}/{pushed_name}"], capture_output=True)
+    pushed_to.clear()
+
+
+atexit.register(discard_pushed)
+
+
+def push_image(targets: list[str], verify: bool) -> tuple[list[str], bool]:
+    # One read of the image for every container, each gets the same chunks on the stdin of `incus file push`. With
+    # `verify` minisign gets them as well. Returns the containers that failed and whether the signature checked out.
+    global image_bytes_read, incus_calls, image_size, pushed_dir
+    pushed_dir = image_dir
+    # The image dir is created along the way
+    pushes = {incus_name: subprocess.Popen([
+        "incus", "file", "push", "--uid", "0", "--gid", "0", "--mode", "0644", "--create-dirs", "-",
+        f"{incus_name}/opt/run-deploy/image/{pushed_dir}/{pushed_name}"
+    ], stdin=subprocess.PIPE) for incus_name in targets}
+    incus_calls += len(pushes)
+    pushed_to.extend(pushes)
+    consumers = list(pushes.values())
+    minisign = None
+    if verify:
+        minisign = subprocess.Popen(
+            ["minisign", "-Vqm", "/dev/stdin", "-x", signature_path, "-p", minisign_public_key_path],
+            stdin=subprocess.PIPE
+        )
+        consumers.append(minisign)
+
+    with open(image_name, "rb") as f:
+        image_size = os.fstat(f.fileno()).st_size
+        while chunk := f.read(ingest_chunk_size):
+            image_bytes_read += len(chunk)
+            for consumer in list(consumers):
+                try:
+                    consumer.stdin.write(chunk)
+                except BrokenPipeError:
+                    # Gave up early, its exit code says why
+                    consumers.remove(consumer)
+    for consumer in consumers:
+        try:
+            consumer.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    failed = [incus_name for incus_name, push in pushes.items() if push.wait() != 0]
+    return failed, minisign is None or minisign.wait() == 0
+
+
+def push_failure(push_failed: list[str]) -> tuple[str, str]:
+    # Nothing checks the containers before the push, so a failed push is where a missing one shows. Only then it is
+    # asked which it was, a full disk isn't a missing container.
+    missing = [incus_name for incus_name in push_failed
+               if run_incus(["info", incus_name], capture_output=True).returncode != 0]
+    if missing:
+        return "CONTAINER_NOT_EXIST", f"Container '{', '.join(missing)}' does not exist"
+    return "IMAGE_PUSH", f"Unable to push '{image_name}' into {', '.join(push_failed)}"
+
+
+# Before anything is taken out of the image, root unpacks `_deploy` and runs what is in it. Streamed images were checked
+# by the socket while they arrived. With a trailer to say where the image goes and a prehashed signature, it is pushed
+# while minisign checks it, a single read, and thrown away again when the signature doesn't check out.
+if not verified and trailer_incus_names and minisig_prehashed():
+    with record_timing("push"):
+        push_failed, signature_valid = push_image(trailer_incus_names, verify=True)
+    if not signature_valid or push_failed:
+        discard_pushed()
+    if not signature_valid:
+        reject_early(
+            "INVALID_SIGNATURE_AUTH",
+            f"Invalid signature for '{image_name}'"
+        )
+    if push_failed:
+        reject_early(*push_failure(push_failed))
+    os.remove(signature_path)
+elif not verified:
+    verify_signature()
+
+mnt_point = tempfile.mkdtemp(prefix="run-deploy-mount-")
+
+
+def extract_deploy_dir() -> bool:
+    # `_deploy` read straight out of the image, False when the built-in reader can't and squashfuse has to mount it
+    if os.path.exists("/opt/run-deploy/options/squashfuse"):
+        return False
+    reader_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "run-deploy-squashfs")
+    if not os.path.exists(reader_path):
+        # Not installed, next to the source
+        reader_path += ".py"
+    try:
+        loader = importlib.machinery.SourceFileLoader("run_deploy_squashfs", reader_path)
+        squashfs = types.ModuleType(loader.name)
+        loader.exec_module(squashfs)
+    except OSError:
+        return False
+    global image_bytes_read
+    deploy_dir = image_name.removesuffix('.squashfs')
+    try:
+        with record_timing("extract"):
+            read = squashfs.extract_dir(image_name, "_deploy", deploy_dir)
+    except squashfs.SquashfsError:
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        return False
+    image_bytes_read += read or 0
+    if read is None or not os.path.exists(f"{deploy_dir}/push.json"):
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        os.remove(image_name)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MANIFEST_NOT_EXIST",
+            "'_deploy/push.json' does not exist"
+        )
+    return True
+
+
+if not extract_deploy_dir():
+    try:
+        subprocess.run(["squashfuse", image_name, mnt_point], check=True)
+    except subprocess.CalledProcessError:
+        os.remove(image_name)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MOUNT",
+            f"Unable to mount '{image_name}'!"
+        )
+
+    if not os.path.exists(f"{mnt_point}/_deploy/push.json"):
+        subprocess.run(["umount", mnt_point])
+        os.remove(image_name)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MANIFEST_NOT_EXIST",
+            "'_deploy/push.json' does not exist"
+        )
 
+    with record_timing("extract"):
+        shutil.copytree(f"{mnt_point}/_deploy", image_name.removesuffix('.squashfs'))
+    subprocess.run(["umount", mnt_point])
+
+if getpass.getuser() == "root":
+    os.chown(image_name, 0, 0)
+shutil.move(image_name, f"{image_name.removesuffix('.squashfs')}/{image_name}")
+
+os.chdir(image_name.removesuffix('.squashfs'))
+
+incus_name = ""
+incus_names = []
+image_dir = ""
+to_exec = ""
+stamp = False
 try:
-    subprocess.run([
-        "incus", "exec", incus_name, "--", "echo", "test"
-    ], check=True, capture_output=True)
-except subprocess.CalledProcessError:
+    data = {}
+    with open("push.json", "r", encoding='utf-8') as f:
+        data = json.load(f)
+
+    data = data[socket.gethostname()]
+    # One container or a list of them, the image is verified and unpacked once for all of them
+    incus_names = data['incus-name']
+    if isinstance(incus_names, str):
+        incus_names = [incus_names]
+    incus_names = [name.strip() for name in incus_names]
+    image_dir = data['image-dir'].strip()
+    to_exec = data['exec'].strip()
+    stamp = data.get("stamp", False)
+except (KeyError, json.JSONDecodeError, AttributeError, TypeError):
+    os.chdir('..')
+    shutil.rmtree(f"{image_name.removesuffix('.squashfs')}")
+    os.rmdir(mnt_point)
+    error_and_exit(
+        "MANIFEST_JSON",
+        "Manifest is not well-formed!"
+    )
+
+# Sanity check
+for incus_name in incus_names + incus_filter:
+    file_name_validation(incus_name, "incus_name", True)
+file_name_validation(to_exec, "to_exec")
+file_name_validation(image_dir, "image_dir", True)
+
+cleanup_dir = f"{image_name.removesuffix('.squashfs')}"
+
+if incus_filter:
+    if set(incus_filter).difference(incus_names):
+        os.chdir('..')
+        shutil.rmtree(cleanup_dir)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MANIFEST_INCUS",
+            f"Only {', '.join(incus_names)} can be deployed to with this image"
+        )
+    incus_names = [name for name in incus_names if name in incus_filter]
+if not incus_names:
+    os.chdir('..')
+    shutil.rmtree(cleanup_dir)
+    os.rmdir(mnt_point)
+    error_and_exit(
+        "MANIFEST_JSON",
+        "Manifest is not well-formed!"
+    )
+
+
+def clean_up():
+    os.chdir('..')
+    shutil.rmtree(cleanup_dir)
+    os.rmdir(mnt_point)
+
+
+# The image went in by what the trailer said, which the signature covers, `_deploy/push.json` must say the same
+if pushed_to and (image_dir != pushed_dir or sorted(incus_names) != sorted(pushed_to)):
+    clean_up()
     error_and_exit(
-        "CONTAINER_NOT_EXIST",
-        f"Container '{incus_name}' does not exist"
+        "MANIFEST_JSON",
+        "'_deploy/push.json' does not match the manifest trailer"
     )
 
-# Create directory if not exist
-subprocess.run([
-    "incus", "exec", incus_name, "--", "mkdir", "-p", f"/opt/run-deploy/image/{image_dir}"
-], capture_output=True)
+
+def lock_target(name: str) -> int:
+    os.makedirs("/opt/run-deploy/lock", exist_ok=True)
+    lock_fd = os.open(f"/opt/run-deploy/lock/{name}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    return lock_fd
+
+
+target_locks = []
+# Sorted, so two deploys to overlapping containers take the locks in the same order
+for incus_name in sorted(incus_names):
+    Permission.create().must_be_full()
+
+    # Deploys and reverts to the same image dir take turns, so the symlink swap stays safe
+    target_locks.append(lock_target(f"incus.{incus_name}.{image_dir}"))
 
 image_name_dir = f"{image_name.removesuffix('.squashfs')}"
 
@@ -243,39 +548,58 @@ if not os.path.exists(to_exec):
         f"'{to_exec}' does not exist"
     )
 
-# Upload Image to Incus container
-subprocess.run([
-    "incus", "file", "push", "--uid", "0", "--gid", "0", image_name, f"{incus_name}/opt/run-deploy/image/{image_dir}/"
-], check=True)
-
 # Copy Exec (Enforce name convention)
 if to_exec != image_name.removesuffix('.squashfs'):
     shutil.copy(to_exec, image_name.removesuffix('.squashfs'))
-    subprocess.run([
-        "incus", "file", "push", "--uid", "0", "--gid", "0", image_name.removesuffix('.squashfs'),
-        f"{incus_name}/opt/run-deploy/image/{image_dir}/"
-    ], check=True)
-else:
-    subprocess.run([
-        "incus", "file", "push", "--uid", "0", "--gid", "0", to_exec, f"{incus_name}/opt/run-deploy/image/{image_dir}/"
-    ], check=True)
 
 # Blame
 pathlib.Path(f"{image_name.removesuffix('.squashfs')}.blame").write_text(key_ref, 'utf-8')
-subprocess.run([
-    "incus", "file", "push", "--uid", "0", "--gid", "0", f"{image_name.removesuffix('.squashfs')}.blame",
-    f"{incus_name}/opt/run-deploy/image/{image_dir}/"
-], check=True)
 
+if not pushed_to:
+    with record_timing("push"):
+        push_failed, _ = push_image(incus_names, verify=False)
+    if push_failed:
+        discard_pushed()
+        clean_up()
+        error_and_exit(*push_failure(push_failed))
+
+# Renames the pushed image (`$5`) into place, puts the exec script (from stdin) and the blame next to it and, unless `$4`
+# is `stage`, runs it, one call into the container. The blame goes last, the revision is only listed once it is there.
+activate_script = """(cd "$1" && mv -f "$5" "$2.squashfs" && cat > "$2" && chmod 755 "$2" && printf %s "$3" > "$2.blame") || {
+    echo "Unable to put $2 in place" >&2
+    exit 1
+}
+[ "$4" = stage ] && exit 0
+exec "$1/$2"
+"""
+
+exec_script = pathlib.Path(image_name.removesuffix('.squashfs')).read_bytes()
 clean_up()
 
 # Exec
-try:
-    subprocess.run([
-        "incus", "exec", incus_name, "--", f"/opt/run-deploy/image/{image_dir}/{image_name.removesuffix('.squashfs')}"
-    ], check=True)
-except subprocess.CalledProcessError as e:
-    error_and_exit(
-        "EXEC_FAIL",
-        f"Image script execution return error code {e.returncode}: {e.output.decode('utf-8')}"
-    )
+exec_fail = None
+for incus_name in incus_names:
+    # Once one fails, the rest only get the revision in place, as `--stage` would
+    mode = "stage" if stage or exec_fail else "run"
+    try:
+        with record_timing("activate"):
+            run_incus([
+                "exec", incus_name, "--", "sh", "-c", activate_script, "activate", f"/opt/run-deploy/image/{image_dir}",
+                image_name.removesuffix('.squashfs'), key_ref, mode, pushed_name
+            ], input=exec_script, check=True)
+    except subprocess.CalledProcessError as e:
+        exec_fail = exec_fail or (
+            "EXEC_FAIL",
+            f"Image script execution return error code {e.returncode} in container '{incus_name}'"
+        )
+
+# Renamed into place by now, or left behind by a failed activation, either way not ours to delete anymore
+pushed_to.clear()
+print(f"Read {image_bytes_read} bytes for the {image_size} byte image ({image_bytes_read / image_size:.2f} passes)")
+print_timings()
+if exec_fail:
+    error_and_exit(*exec_fail)
+
+if stage:
+    print(image_name.removesuffix('.squashfs'))
+    exit(0)
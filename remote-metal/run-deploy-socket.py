@@ -1,33 +1,207 @@
 #!/usr/bin/env python3
+import base64
+import binascii
+import codecs
+import collections
+import contextlib
+import ctypes
+import dataclasses
+import fnmatch
+import functools
+import hashlib
+import hmac
+import importlib.machinery
 import json
 import os
 import pathlib
+import select
+import selectors
+import shutil
+import signal
+import socket
+import string
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import traceback
+import types
 import getpass
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, ContextManager, Self
 
-arg_cmd = sys.argv[1]
 commands: dict = {}
 
+queue_dir = "/tmp/run-deploy-queue"
+queue_pattern = "run-deploy-*-queue"
+
+# Served by `serve`, clients fall back to the queue when it is not there
+socket_path = "/run/run-deploy.sock"
+socket_backlog = 128
+
+# Verified session tokens, kept by run-deploy-cli
+session_dir = "/opt/run-deploy/session"
+
+# Largest request root reads, from the socket or a send fifo, the image of a `deploy-stream` isn't part of it
+request_max_size = 1024 * 1024
+
+# Seconds root waits for a client to write its request into the send fifo
+send_fifo_timeout = 30
+
+# Bytes read from a job's stdout/stderr before forwarding it to the client
+stream_chunk_size = 65536
+
+# Seconds between re-checks of the reply fifo while waiting on inotify, in case an event was missed
+reply_fifo_recheck = 1
+
+# Partial uploads left behind by `upload` are removed once they are this many seconds old
+upload_partial_max_age = 86400
+
+# Images of `deploy-stream` are written here, root only and on the same filesystem as `/opt/run-deploy/image`
+stream_dir = "/opt/run-deploy/stream"
+
+# Bytes read from a streamed image at a time, and seconds root waits for the next ones before giving up
+stream_image_chunk_size = 1024 * 1024
+stream_image_timeout = 300
+
+# Mutating requests (deploy, revert, exec ...) handled at the same time,
+# override with `/opt/run-deploy/options/socket-concurrency`
+default_concurrency = 4
+
+# Read-only requests handled at the same time, they have their own lane so they never wait behind a deploy,
+# override with `/opt/run-deploy/options/socket-read-concurrency`
+default_read_concurrency = 4
+
+# Cli commands that only read, they go into the read lane
+read_only_commands = [
+    'edition',
+    'last-deploy',
+    'last-deploy-blame',
+    'list-revision',
+    'list-image',
+    'list-exec',
+    'permission-json',
+    'preflight',
+    'batch'
+]
+
+# Cli requests fork from a helper started before the first thread, a fork of the daemon could inherit a lock another
+# thread held. Its control socket, cli requests run as a subprocess without one.
+cli_forker: socket.socket | None = None
+cli_forker_lock = threading.Lock()
+
+# Cli scripts loaded into the helper, keyed by path and holding the mtime they were loaded at
+cli_modules: dict = {}
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+
+@dataclass(frozen=True)
+class Inotify:
+    fd: int
+
+    @classmethod
+    def create(cls, path: str, mask: int) -> Self:
+        # libc is already loaded into the interpreter, no need for `ctypes.util.find_library`
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(fd, path.encode('utf-8'), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"inotify_add_watch failed for '{path}'")
+        return cls(fd=fd)
+
+    def read_events(self, timeout: float | None = None) -> list[tuple[str, int]]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        buffer = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            _, mask, _, name_len = struct.unpack_from("iIII", buffer, offset)
+            offset += struct.calcsize("iIII")
+            name = buffer[offset:offset + name_len].rstrip(b"\0").decode('utf-8')
+            offset += name_len
+            events.append((name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def wait_for_fifo(fifo_path: str):
+    if os.access(fifo_path, os.R_OK):
+        return
+    # Root creates the fifo then chowns it, so wake on both and check again
+    try:
+        watcher = Inotify.create(os.path.dirname(fifo_path), IN_CREATE | IN_ATTRIB)
+    except OSError:
+        while not os.access(fifo_path, os.R_OK):
+            time.sleep(reply_fifo_recheck)
+        return
+    try:
+        while not os.access(fifo_path, os.R_OK):
+            watcher.read_events(reply_fifo_recheck)
+    finally:
+        watcher.close()
+
+
+def write_frame(stream: BinaryIO, data: dict):
+    payload = json.dumps(data).encode('utf-8')
+    stream.write(struct.pack(">I", len(payload)) + payload)
+    stream.flush()
+
+
+def read_frame(stream: BinaryIO, header: bytes = b"", max_size: int | None = None) -> dict | None:
+    header += stream.read(4 - len(header))
+    if len(header) < 4:
+        return None
+    (size,) = struct.unpack(">I", header)
+    if max_size is not None and size > max_size:
+        raise ValueError(f"Frame of {size} bytes is over {max_size} bytes")
+    return json.loads(stream.read(size).decode('utf-8'))
+
+
+def print_frames(stream: BinaryIO) -> int:
+    while (data := read_frame(stream)) is not None:
+        if data.get("stdout"):
+            sys.stdout.write(data["stdout"])
+            sys.stdout.flush()
+        if data.get("stderr"):
+            sys.stderr.write(data["stderr"])
+            sys.stderr.flush()
+        if "code" in data:
+            return data["code"]
+    print("Reply ended without an exit code", file=sys.stderr)
+    return 1
+
 
 def handle_recv_fifo(fifo_path: str):
-    while not os.access(fifo_path, os.R_OK):
-        time.sleep(1)
-    with open(fifo_path, "r") as fifo:
-        data = json.load(fifo)
-    if data["stderr"]:
-        print(data["stderr"], file=sys.stderr)
-    if data["stdout"]:
-        print(data["stdout"])
-    exit(data["code"])
+    wait_for_fifo(fifo_path)
+    with open(fifo_path, "rb") as fifo:
+        code = print_frames(fifo)
+    exit(code)
 
 
 def create_send_fifo_add_to_queue() -> str:
-    fifo_path = f"/tmp/run-deploy-recv-fifo-{time.time()}"
+    fifo_path = f"/tmp/run-deploy-recv-fifo-{time.time()}-{os.getpid()}"
     os.mkfifo(fifo_path, 0o640)
 
-    pathlib.Path(f"/tmp/run-deploy-queue/run-deploy-{time.time()}-queue").write_text(fifo_path, "utf-8")
+    # Write then rename, so root never picks up a half written queue file
+    queue_name = f"run-deploy-{time.time()}-{os.getpid()}-queue"
+    queue_tmp_path = pathlib.Path(f"{queue_dir}/.{queue_name}")
+    queue_tmp_path.write_text(fifo_path, "utf-8")
+    os.rename(queue_tmp_path, f"{queue_dir}/{queue_name}")
 
     # Trigger systemd oneshot
     pathlib.Path("/tmp/run-deploy.path").touch()
@@ -41,18 +215,33 @@ def check_permission():
         exit(100)
 
 
-def send_cli(cmd: str = "cli"):
+def connect_socket() -> socket.socket | None:
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        # Stale socket or `serve` is not running, fall back to the queue
+        sock.close()
+        return None
+    return sock
+
+
+def send_request(data: dict):
     check_permission()
 
-    fifo_recv_path = f"/tmp/run-deploy-{cmd}-fifo-{time.time()}"
+    sock = connect_socket()
+    if sock:
+        with sock, sock.makefile("wb") as sock_writer, sock.makefile("rb") as sock_reader:
+            write_frame(sock_writer, data)
+            code = print_frames(sock_reader)
+        exit(code)
 
-    data = {
-        "cmd": cmd,
-        "token": os.environ['RUN_DEPLOY_TOKEN'].strip(),
-        "key": os.environ['RUN_DEPLOY_KEY'].strip(),
-        "args": sys.argv[2:],
-        "fifo": fifo_recv_path
-    }
+    # Other processes of the deploy user could read a send fifo, the session secret only goes through the socket
+    data.pop("secret", None)
+    fifo_recv_path = f"/tmp/run-deploy-{data['cmd']}-fifo-{time.time()}-{os.getpid()}"
+    data["fifo"] = fifo_recv_path
 
     fifo_send_path = create_send_fifo_add_to_queue()
 
@@ -65,99 +254,1034 @@ def send_cli(cmd: str = "cli"):
     handle_recv_fifo(fifo_recv_path)
 
 
+def send_cli(cmd: str = "cli"):
+    data = {
+        "cmd": cmd,
+        "token": os.environ['RUN_DEPLOY_TOKEN'].strip(),
+        "key": os.environ['RUN_DEPLOY_KEY'].strip(),
+        "args": sys.argv[2:]
+    }
+    # The secret of a session comes first on stdin, see `read_session_secret` in run-deploy-cli
+    if os.environ.get("RUN_DEPLOY_SESSION_STDIN"):
+        data["secret"] = sys.stdin.readline().strip()
+    send_request(data)
+
+
 commands["cli"] = send_cli
 
 
-def deploy(cmd: str = "deploy"):
-    check_permission()
+def deploy_options(start: int) -> dict:
+    # With `--stage` the image is put in place but not executed, `run-deploy-cli revert` activates it later.
+    # `--incus` (repeated) picks some of the containers the manifest lists for this host.
+    return {
+        "stage": "--stage" in sys.argv[start:],
+        "incus": [sys.argv[i + 1].strip() for i in range(start, len(sys.argv) - 1) if sys.argv[i] == "--incus"]
+    }
 
-    fifo_recv_path = f"/tmp/run-deploy-{cmd}-fifo-{time.time()}"
 
-    data = {
+def deploy(cmd: str = "deploy"):
+    send_request({
         "cmd": cmd,
         "target": sys.argv[2].strip(),
-        "key": sys.argv[3].strip(),
-        "fifo": fifo_recv_path
-    }
+        "key": sys.argv[3].strip()
+    } | deploy_options(4))
 
-    fifo_send_path = create_send_fifo_add_to_queue()
 
-    with open(fifo_send_path, "w") as fifo:
-        json.dump(data, fifo)
-        fifo.flush()
+commands["deploy"] = deploy
 
-    os.remove(fifo_send_path)
 
-    handle_recv_fifo(fifo_recv_path)
+def deploy_stream(cmd: str = "deploy-stream"):
+    # `deploy-stream NAME KEY SIZE MINISIG`, the image itself is on stdin and MINISIG is the url-safe base64 of its
+    # `.minisig`. Stdin is handed to `serve` with the request, root writes the bytes once and checks the signature
+    # while they arrive, so nothing is uploaded beforehand.
+    check_permission()
+    try:
+        data = {
+            "cmd": cmd,
+            "name": sys.argv[2].strip(),
+            "key": sys.argv[3].strip(),
+            "size": int(sys.argv[4]),
+            "minisig": base64.urlsafe_b64decode(sys.argv[5]).decode('utf-8')
+        } | deploy_options(6)
+    except (IndexError, ValueError):
+        error_and_exit("ARGUMENT", "Must have NAME, KEY, SIZE and MINISIG")
 
+    sock = connect_socket()
+    if sock is None:
+        # The queue can't carry a file descriptor
+        error_and_exit("STREAM_UNAVAILABLE", "`run-deploy-socket serve` is not running, upload the image and deploy it")
+    payload = json.dumps(data).encode('utf-8')
+    frame = struct.pack(">I", len(payload)) + payload
+    with sock, sock.makefile("rb") as sock_reader:
+        sent = socket.send_fds(sock, [frame], [sys.stdin.fileno()])
+        sock.sendall(frame[sent:])
+        code = print_frames(sock_reader)
+    exit(code)
 
-commands["deploy"] = deploy
 
+commands["deploy-stream"] = deploy_stream
 
-def root_fail(fifo_path: str, code: int, msg: str):
-    with open(fifo_path, "w") as fifo:
-        json.dump({
-            "code": code,
-            "stderr": msg,
-            "stdout": ""
-        }, fifo)
-        fifo.flush()
+
+def status():
+    send_request({"cmd": "status"})
+
+
+commands["status"] = status
+
+
+def error_and_exit(error_name: str, message: str):
+    json.dump({"error_name": error_name, "message": message}, sys.stderr, indent="\t")
+    exit(100)
+
+
+def read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def upload():
+    # Resumable upload, runs as the deploy user over ssh, no root involved. The file is kept as
+    # `.run-deploy-partial-{sha256}` in the upload dir with a line per chunk received, a broken connection only costs
+    # the chunk it was in, the next run carries on from the offset it prints first.
+    # stdin: chunks of `>I` length + sha256 + data, a zero length ends it.
+    try:
+        upload_dir, name, digest, size = sys.argv[2:6]
+        size = int(size)
+    except ValueError:
+        error_and_exit("ARGUMENT", "upload UPLOAD_DIR NAME SHA256 SIZE")
+    if set(name).difference(string.ascii_letters + string.digits + '.-_') or name.startswith("."):
+        error_and_exit("FILE_NAME_VALIDATION", "name must be `ascii letters + digits + .-_`")
+    if len(digest) != 64 or set(digest).difference(string.hexdigits.lower()):
+        error_and_exit("UPLOAD_DIGEST", "Digest must be a sha256 in hex")
+    if not os.path.isdir(upload_dir):
+        error_and_exit("UPLOAD_DIR", f"'{upload_dir}' is not a directory")
+
+    now = time.time()
+    for stale in pathlib.Path(upload_dir).glob(".run-deploy-partial-*"):
+        try:
+            if now - stale.stat().st_mtime > upload_partial_max_age:
+                stale.unlink()
+        except OSError:
+            pass
+
+    partial_path = f"{upload_dir}/.run-deploy-partial-{digest}"
+    sums_path = f"{partial_path}.sums"
+    # Only what a checksum line vouches for is kept, anything past it was cut off mid chunk
+    offset = 0
+    if os.path.exists(sums_path):
+        with open(sums_path, "r") as f:
+            offset = sum(int(line.split(" ")[0]) for line in f if line.strip())
+    with open(partial_path, "ab") as f:
+        # `tell()` of an append handle stays at the old end after `truncate()`
+        offset = min(offset, os.fstat(f.fileno()).st_size)
+        f.truncate(offset)
+    sys.stdout.write(f"{offset}\n")
+    sys.stdout.flush()
+
+    with open(partial_path, "ab") as partial, open(sums_path, "a") as sums:
+        while True:
+            header = read_exact(sys.stdin.buffer, 4)
+            if len(header) < 4:
+                exit(1)
+            (length,) = struct.unpack(">I", header)
+            if length == 0:
+                break
+            chunk_digest = read_exact(sys.stdin.buffer, 32)
+            data = read_exact(sys.stdin.buffer, length)
+            if len(data) < length:
+                # Connection went away mid chunk
+                exit(1)
+            if hashlib.sha256(data).digest() != chunk_digest:
+                error_and_exit("CHUNK_CHECKSUM", f"Chunk at {offset} does not match its checksum")
+            partial.write(data)
+            partial.flush()
+            os.fsync(partial.fileno())
+            sums.write(f"{length} {chunk_digest.hex()}\n")
+            sums.flush()
+            offset += length
+
+    if offset < size:
+        exit(1)
+    with open(partial_path, "rb") as f:
+        if offset != size or hashlib.file_digest(f, "sha256").hexdigest() != digest:
+            os.remove(partial_path)
+            os.remove(sums_path)
+            error_and_exit("UPLOAD_CHECKSUM", "Uploaded file does not match its checksum, start over")
+    os.rename(partial_path, f"{upload_dir}/{name}")
+    os.remove(sums_path)
+
+
+commands["upload"] = upload
+
+
+@dataclass
+class Reply:
+    stream: BinaryIO
+    closed: bool = False
+
+    def send(self, data: dict):
+        if self.closed:
+            return
+        try:
+            write_frame(self.stream, data)
+        except ConnectionError:
+            # Client went away, the job still runs to the end
+            self.closed = True
+
+
+def root_fail(reply: Reply, code: int, msg: str):
+    reply.send({"stderr": msg + "\n"})
+    reply.send({"code": code})
+
+
+def error_reply(reply: Reply, error_name: str, message: str):
+    # Same contract as `error_and_exit` in run-deploy-cli
+    root_fail(reply, 100, json.dumps({"error_name": error_name, "message": message}, indent="\t"))
+
+
+class SharedReply:
+    # Fans the frames of one job out to every client asking the same thing, late joiners get the frames so far first
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames: list[dict] = []
+        self.replies: list[Reply] = []
+        self.finished = threading.Event()
+
+    def send(self, data: dict):
+        with self.lock:
+            self.frames.append(data)
+            for reply in self.replies:
+                reply.send(data)
+
+    def join(self, reply: Reply):
+        with self.lock:
+            for frame in self.frames:
+                reply.send(frame)
+            if not self.finished.is_set():
+                self.replies.append(reply)
+
+    def finish(self):
+        with self.lock:
+            self.finished.set()
+
+
+def load_session(token_ref: str, key_ref: str, secret: str | None) -> dict | None:
+    # Written by run-deploy-cli when it verifies a session token, see `store_session` there
+    if not secret:
+        return None
+    path = f"{session_dir}/{hashlib.sha256(token_ref.encode('utf-8')).hexdigest()}.json"
+    try:
+        with open(path, "r") as f:
+            session = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if session.get("expires", 0) <= time.time() or session.get("key") != key_ref:
+        return None
+    if not hmac.compare_digest(str(session.get("proof", "")), hashlib.sha256(secret.encode('utf-8')).hexdigest()):
+        return None
+    return session
+
+
+def arg_value(args: list, flag: str) -> str | None:
+    for i, arg in enumerate(args):
+        if arg == flag and i + 1 < len(args):
+            return args[i + 1]
+        if arg.startswith(f"{flag}="):
+            return arg.split("=", maxsplit=1)[1]
+    return None
 
 
-def handle_subprocess(fifo_path: str, args: list, env=None):
+def request_images(args: list) -> list:
+    # The images a cli request reads, each query of a batch has its own
+    if cli_command(args) != "batch":
+        return [arg_value(args, "--image")]
+    try:
+        queries = json.loads(base64.urlsafe_b64decode(arg_value(args, "--queries") or ""))
+        return [query.get("image", None) for query in queries]
+    except (binascii.Error, ValueError, TypeError, AttributeError):
+        return [None]
+
+
+def verify_token(data: dict, reply: Reply) -> bool:
+    # Coalesced requests never reach run-deploy-cli, so their token is checked here the same way
+    token_ref = data["token"]
+    key_ref = data["key"]
+    if set(token_ref).difference(string.ascii_letters + string.digits):
+        error_reply(reply, "TOKEN_REF_VALIDATION", "Key ref must be `ascii letters + digits`")
+        return False
+    if set(key_ref).difference(string.ascii_letters + string.digits + '@_-.'):
+        error_reply(reply, "KEY_REF_VALIDATION", "Key ref must be `ascii letters + digits + @_-.`")
+        return False
+    session = load_session(token_ref, key_ref, data.get("secret"))
+    if session:
+        if session["image"] is not None and any(image != session["image"] for image in request_images(data["args"])):
+            error_reply(reply, "SESSION_SCOPE", f"Session is only for image `{session['image']}`")
+            return False
+        return True
+    token_path = f"/tmp/run-deploy/run-deploy-token-{token_ref}"
+    if not os.path.exists(token_path):
+        error_reply(reply, "SESSION_NOT_FOUND", f"No token or session for '{token_ref}', the session may have expired")
+        return False
+    # A session token joining a coalesced job is only good for this request, the next call signs a new one
+    verify_dir = tempfile.mkdtemp(prefix="run-deploy-token-")
+    try:
+        shutil.copyfile(token_path, f"{verify_dir}/token")
+        shutil.copyfile(f"{token_path}.minisig", f"{verify_dir}/token.minisig")
+        subprocess.run(
+            ["minisign", "-Vqm", f"{verify_dir}/token", "-p", f"/opt/run-deploy/minisign/{key_ref}.pub"],
+            check=True, capture_output=True
+        )
+        return True
+    except (subprocess.CalledProcessError, OSError):
+        error_reply(reply, "INVALID_SIGNATURE_AUTH", f"Invalid signature for '{token_path}'")
+        return False
+    finally:
+        shutil.rmtree(verify_dir, ignore_errors=True)
+        for path in [token_path, f"{token_path}.minisig"]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+def stream_output(reply: Reply, stdout: BinaryIO, stderr: BinaryIO):
+    with selectors.DefaultSelector() as selector:
+        # Incremental decoders, a chunk can end halfway through a multibyte character
+        for name, pipe in [("stdout", stdout), ("stderr", stderr)]:
+            selector.register(pipe, selectors.EVENT_READ, (name, codecs.getincrementaldecoder('utf-8')('replace')))
+        while selector.get_map():
+            for key, _ in selector.select():
+                name, decoder = key.data
+                chunk = os.read(key.fd, stream_chunk_size)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                text = decoder.decode(chunk, final=not chunk)
+                if text:
+                    reply.send({name: text})
+
+
+def stream_process(process: subprocess.Popen, reply: Reply) -> int:
+    stream_output(reply, process.stdout, process.stderr)
+    code = process.wait()
+    reply.send({"code": code})
+    return code
+
+
+def handle_subprocess(reply: Reply, args: list, env=None, stdin_data: bytes | None = None):
     if env is None:
         env = {}
-    process = subprocess.run(args, env=env|os.environ, capture_output=True)
-    with open(fifo_path, "w") as fifo:
-        json.dump({
-            "code": process.returncode,
-            "stdout": process.stdout.decode('utf-8').strip(),
-            "stderr": process.stderr.decode('utf-8').strip()
-        }, fifo)
-        fifo.flush()
+    try:
+        process = subprocess.Popen(
+            args, env=env|os.environ, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=None if stdin_data is None else subprocess.PIPE
+        )
+    except OSError as e:
+        root_fail(reply, 1, e.__str__())
+        return
+    with process:
+        if stdin_data is not None:
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.write(stdin_data)
+            process.stdin.close()
+        stream_process(process, reply)
 
 
-def process_queue(recv_fifo_path: str):
-    if not os.path.exists(recv_fifo_path):
-        time.sleep(1)
+def load_cli(path: str) -> types.ModuleType | None:
+    # Importing the cli costs as much as starting it, so it is done once and again only when the file changes
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        cached = cli_modules.get(path)
+        if cached is None or cached[0] != mtime:
+            loader = importlib.machinery.SourceFileLoader(f"run_deploy_cli_{len(cli_modules)}", path)
+            module = types.ModuleType(loader.name)
+            module.__file__ = path
+            loader.exec_module(module)
+            cached = (mtime, module)
+            cli_modules[path] = cached
+        return cached[1]
+    except Exception as e:
+        print(f"Could not load '{path}', running it as a subprocess: {e}", file=sys.stderr)
+        return None
+
+
+def run_cli_child(module: types.ModuleType | None, path: str, args: list, env: dict, stdin_fd: int, stdout_fd: int,
+                  stderr_fd: int):
+    code = 1
+    try:
+        os.dup2(stdin_fd, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        # Drop everything else inherited from the daemon, other jobs' pipes would not see EOF while this runs
+        for fd in os.listdir("/proc/self/fd"):
+            if int(fd) > 2:
+                with contextlib.suppress(OSError):
+                    os.close(int(fd))
+        # New objects, another thread of the daemon may have been halfway through writing to the old ones
+        sys.stdin = open(0, "r", closefd=False)
+        sys.stdout = open(1, "w", closefd=False)
+        sys.stderr = open(2, "w", closefd=False)
+        os.environ.update(env)
+        if module is None:
+            os.execv(path, [path] + args)
+        sys.argv = [module.__file__] + args
+        module.main(args)
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except OSError as e:
+        print(e.__str__(), file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        with contextlib.suppress(BaseException):
+            sys.stdout.flush()
+            sys.stderr.flush()
+        os._exit(code)
+
+
+def run_cli_waiter(request: socket.socket, module: types.ModuleType | None, data: dict, fds: list):
+    # Forks the cli and sends back how it exited, the helper itself never waits
+    code = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        pid = os.fork()
+        if pid == 0:
+            request.close()
+            run_cli_child(module, data["path"], data["args"], data["env"], *fds)
+        for fd in fds:
+            os.close(fd)
+        _, wait_status = os.waitpid(pid, 0)
+        code = os.waitstatus_to_exitcode(wait_status)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        with contextlib.suppress(OSError):
+            request.sendall(json.dumps({"code": code}).encode('utf-8'))
+        os._exit(0)
+
+
+def run_cli_forker(control: socket.socket):
+    # Single threaded for its whole life, so forking it is safe. Each request brings its own socket, carrying the json
+    # of the request one way and the exit code the other, and the stdin, stdout and stderr of the cli.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    try:
+        while True:
+            message, fds, _, _ = socket.recv_fds(control, 16, 4)
+            if not message:
+                # The daemon is gone
+                break
+            if len(fds) != 4:
+                for fd in fds:
+                    os.close(fd)
+                continue
+            with socket.socket(fileno=fds[0]) as request:
+                try:
+                    with request.makefile("rb") as request_reader:
+                        data = json.loads(request_reader.read())
+                    module = load_cli(data["path"])
+                    if os.fork() == 0:
+                        control.close()
+                        run_cli_waiter(request, module, data, fds[1:])
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    print(f"Could not run a cli request: {e}", file=sys.stderr)
+                for fd in fds[1:]:
+                    os.close(fd)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        os._exit(0)
+
+
+def start_cli_forker():
+    # Before any thread is started
+    global cli_forker
+    control, forker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork() == 0:
+        control.close()
+        run_cli_forker(forker_control)
+    forker_control.close()
+    cli_forker = control
+
+
+def handle_cli(reply: Reply, path: str, args: list, env: dict, stdin_data: bytes = b""):
+    if cli_forker is None:
+        handle_subprocess(reply, [path] + args, env, stdin_data)
         return
-    path_gid = os.stat(recv_fifo_path).st_gid
-    with open(recv_fifo_path, "r") as fifo:
-        data = json.load(fifo)
-    fifo_path = data["fifo"]
-    os.mkfifo(fifo_path, 0o640)
-    os.chown(fifo_path, 0, path_gid)
+    # Small enough to sit in the pipe until the cli reads it
+    stdin_read, stdin_write = os.pipe()
+    os.write(stdin_write, stdin_data)
+    os.close(stdin_write)
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    request, forker_request = socket.socketpair()
+    try:
+        with cli_forker_lock:
+            socket.send_fds(cli_forker, [b"cli"], [forker_request.fileno(), stdin_read, stdout_write, stderr_write])
+    except OSError as e:
+        request.close()
+        os.close(stdout_read)
+        os.close(stderr_read)
+        root_fail(reply, 1, e.__str__())
+        return
+    finally:
+        forker_request.close()
+        for fd in [stdin_read, stdout_write, stderr_write]:
+            os.close(fd)
+    with request, request.makefile("rb") as request_reader:
+        with contextlib.suppress(OSError):
+            request.sendall(json.dumps({"path": path, "args": args, "env": env}).encode('utf-8'))
+            request.shutdown(socket.SHUT_WR)
+        with open(stdout_read, "rb") as stdout, open(stderr_read, "rb") as stderr:
+            stream_output(reply, stdout, stderr)
+        try:
+            code = json.loads(request_reader.read())["code"]
+        except (OSError, ValueError, KeyError, TypeError):
+            root_fail(reply, 1, "Could not run the cli, see the log of run-deploy-socket")
+            return
+    reply.send({"code": code})
+
+
+def minisig_prehashed(minisig: str) -> bool:
+    # minisign reads the file of a prehashed (`ED`) signature front to back, so it can check it from a pipe. The legacy
+    # `Ed` needs the whole file.
+    try:
+        return base64.b64decode(minisig.splitlines()[1])[:2] == b"ED"
+    except (IndexError, ValueError):
+        return False
+
+
+def receive_image(fd: int, path: str, size: int, minisign: subprocess.Popen | None) -> int:
+    # Written once to `path` and, when given, fed to minisign on the way
+    received = 0
+    with open(path, "xb") as f:
+        while received < size:
+            ready, _, _ = select.select([fd], [], [], stream_image_timeout)
+            if not ready:
+                break
+            chunk = os.read(fd, min(stream_image_chunk_size, size - received))
+            if not chunk:
+                break
+            f.write(chunk)
+            received += len(chunk)
+            if minisign is not None:
+                try:
+                    minisign.stdin.write(chunk)
+                except BrokenPipeError:
+                    # Gave up early, its exit code says why
+                    minisign = None
+    return received
+
+
+def handle_deploy_stream(reply: Reply, data: dict, stdin: int | None, path: str):
+    if stdin is None:
+        error_reply(reply, "STREAM_UNAVAILABLE", "Streamed deploys only work through `run-deploy-socket serve`")
+        return
+    name, key_ref, size, minisig = data["name"], data["key"], data["size"], data["minisig"]
+    if (set(name).difference(string.ascii_letters + string.digits + '.-_') or not name.endswith(".squashfs")
+            or set(key_ref).difference(string.ascii_letters + string.digits + '@_-.')
+            or not isinstance(size, int) or size <= 0 or not isinstance(minisig, str)):
+        error_reply(reply, "ARGUMENT", "Invalid image name, key or size")
+        return
+    public_key_path = f"/opt/run-deploy/minisign/{key_ref}.pub"
+    if not os.path.exists(public_key_path):
+        error_reply(reply, "INVALID_SIGNATURE_AUTH", f"Invalid signature for '{name}'")
+        return
+
+    os.makedirs(stream_dir, mode=0o700, exist_ok=True)
+    job_dir = tempfile.mkdtemp(prefix="run-deploy-stream-", dir=stream_dir)
+    image_path = f"{job_dir}/{name}"
+    try:
+        pathlib.Path(f"{image_path}.minisig").write_text(minisig, 'utf-8')
+        minisign = None
+        if minisig_prehashed(minisig):
+            minisign = subprocess.Popen([
+                "minisign", "-Vqm", "/dev/stdin", "-x", f"{image_path}.minisig", "-p", public_key_path
+            ], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            received = receive_image(stdin, image_path, size, minisign)
+        finally:
+            if minisign is not None:
+                with contextlib.suppress(BrokenPipeError):
+                    minisign.stdin.close()
+                valid = minisign.wait() == 0
+        if received != size:
+            error_reply(reply, "STREAM_INCOMPLETE", f"Received {received} of {size} bytes of '{name}'")
+            return
+        if minisign is None:
+            valid = subprocess.run([
+                "minisign", "-Vqm", image_path, "-x", f"{image_path}.minisig", "-p", public_key_path
+            ], capture_output=True).returncode == 0
+        if not valid:
+            error_reply(reply, "INVALID_SIGNATURE_AUTH", f"Invalid signature for '{name}'")
+            return
+        # Already verified, run-deploy takes the image from here without reading it again for minisign
+        handle_subprocess(reply, [path, image_path, key_ref, "--verified"] + deploy_flags(data))
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def deploy_flags(data: dict) -> list:
+    flags = []
+    if data.get("stage", False):
+        flags += ["--stage"]
+    for incus_name in data.get("incus", []):
+        if isinstance(incus_name, str):
+            flags += ["--incus", incus_name]
+    return flags
+
+
+# Fields every request of a command must have and their type, anything else is turned away before it is queued
+request_fields = {
+    "status": {},
+    "cli": {"token": str, "key": str, "args": list},
+    "deploy": {"target": str, "key": str},
+    "deploy-stream": {"name": str, "key": str, "size": int, "minisig": str},
+}
+
+# Fields a request may have
+request_optional_fields = {"stage": bool, "incus": list, "image": str, "fifo": str, "secret": str}
+
+
+def request_error(data: dict) -> str | None:
+    fields = request_fields.get(data.get("cmd")) if isinstance(data.get("cmd"), str) else None
+    if fields is None:
+        return "Could not find command"
+    missing = [name for name in fields if name not in data]
+    if missing:
+        return f"Missing '{missing[0]}'"
+    for name, kind in (fields | request_optional_fields).items():
+        if name not in data:
+            continue
+        value = data[name]
+        # bool is an int too, `size` must not be `true`
+        if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+            return f"'{name}' must be {kind.__name__}"
+        if kind is list and not all(isinstance(item, str) for item in value):
+            return f"'{name}' must be a list of str"
+    # Passed on as `--incus NAME`, a name like `--verified` would be taken for a flag of run-deploy
+    if any(incus_name.startswith("-") for incus_name in data.get("incus", [])):
+        return "'incus' must not start with '-'"
+    return None
+
+
+def cli_env(data: dict) -> dict:
+    env = {"RUN_DEPLOY_TOKEN": data['token'], "RUN_DEPLOY_KEY": data['key']}
+    if "secret" in data:
+        env["RUN_DEPLOY_SESSION_STDIN"] = "1"
+    return env
+
+
+def cli_stdin(data: dict) -> bytes:
+    # The session secret never goes into the environment, the cli reads it from stdin
+    if "secret" not in data:
+        return b""
+    return f"{data['secret']}\n".encode('utf-8')
+
+
+def process_request(data: dict, reply: Reply, stdin: int | None = None):
     try:
         match data:
             case {"cmd": "cli"}:
-                handle_subprocess(fifo_path, ["/opt/run-deploy/bin/run-deploy-cli"] + data['args'], {
-                    "RUN_DEPLOY_TOKEN": data['token'],
-                    "RUN_DEPLOY_KEY": data['key']
-                })
+                handle_cli(reply, "/opt/run-deploy/bin/run-deploy-cli", data['args'], cli_env(data), cli_stdin(data))
             case {"cmd": "deploy"}:
-                handle_subprocess(fifo_path, ["/opt/run-deploy/bin/run-deploy", data["target"], data["key"]])
+                handle_subprocess(reply, ["/opt/run-deploy/bin/run-deploy", data["target"], data["key"]] + deploy_flags(data))
+            case {"cmd": "deploy-stream"}:
+                handle_deploy_stream(reply, data, stdin, "/opt/run-deploy/bin/run-deploy")
+            case _:
+                root_fail(reply, 1, "Could not find command")
     except KeyError as e:
-        root_fail(fifo_path, 1, e.__str__())
-    os.remove(fifo_path)
-    time.sleep(1)
+        root_fail(reply, 1, e.__str__())
+    except Exception as e:
+        # Whatever went wrong, the client still gets its exit code
+        print(f"{type(e).__name__}: {e.__str__()}", file=sys.stderr)
+        root_fail(reply, 1, f"Request failed: {e.__str__()}")
 
 
-def recv():
+def cli_command(args: list) -> str:
+    # Same as argparse, the command is the first argument that isn't a flag or the value of one
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg.startswith("-"):
+            skip = "=" not in arg
+        else:
+            return arg
+    return ""
+
+
+def request_lane(data: dict) -> str:
+    if data.get("cmd") == "cli" and cli_command(data.get("args", [])) in read_only_commands:
+        return "read"
+    return "write"
+
+
+@dataclass(frozen=True)
+class Job:
+    data: dict
+    open_reply: Callable[[], ContextManager[Reply]]
+    shared: SharedReply | None = None
+    # The client's stdin, passed along with a `deploy-stream` request
+    stdin: int | None = None
+
+    def run(self):
+        if self.shared is None:
+            try:
+                with self.open_reply() as reply:
+                    process_request(self.data, reply, self.stdin)
+            finally:
+                if self.stdin is not None:
+                    os.close(self.stdin)
+            return
+        try:
+            with self.open_reply() as reply:
+                self.shared.join(reply)
+                process_request(self.data, self.shared)
+        finally:
+            self.shared.finish()
+
+    def join(self, shared: SharedReply):
+        with self.open_reply() as reply:
+            if not verify_token(self.data, reply):
+                return
+            shared.join(reply)
+            shared.finished.wait()
+
+
+def coalesce_key(data: dict) -> tuple:
+    return data["cmd"], tuple(data["args"]), data["key"]
+
+
+class Dispatcher:
+    def __init__(self, read_workers: int, write_workers: int):
+        self.condition = threading.Condition()
+        self.receiving = 0
+        self.read_jobs: collections.deque[Job] = collections.deque()
+        # Read jobs queued or running, identical requests join them instead of running again
+        self.inflight: dict[tuple, SharedReply] = {}
+        # Mutating jobs are queued per key and taken round-robin, so one busy key can't starve the others
+        self.write_jobs: dict[str, collections.deque[Job]] = {}
+        self.write_keys: collections.deque[str] = collections.deque()
+        self.workers = {"read": read_workers, "write": write_workers}
+        self.running = {"read": 0, "write": 0}
+        for lane, count in self.workers.items():
+            for _ in range(count):
+                threading.Thread(target=self.work, args=(lane,), daemon=True).start()
+
+    def receive(self, read_job: Callable[[], Job | None]):
+        # Reading a request can block on a slow client, so it gets its own thread
+        with self.condition:
+            self.receiving += 1
+        threading.Thread(target=self.receive_job, args=(read_job,), daemon=True).start()
+
+    def receive_job(self, read_job: Callable[[], Job | None]):
+        try:
+            job = read_job()
+            if job:
+                self.submit(job)
+        except Exception as e:
+            print(f"{type(e).__name__}: {e.__str__()}", file=sys.stderr)
+        finally:
+            with self.condition:
+                self.receiving -= 1
+                self.condition.notify_all()
+
+    def submit(self, job: Job):
+        error = request_error(job.data)
+        if error:
+            with job.open_reply() as reply:
+                root_fail(reply, 1, error)
+            if job.stdin is not None:
+                os.close(job.stdin)
+            return
+        if job.data.get("cmd") == "status":
+            with job.open_reply() as reply:
+                reply.send({"stdout": json.dumps(self.status(), indent="\t") + "\n"})
+                reply.send({"code": 0})
+            return
+        if request_lane(job.data) == "read":
+            key = coalesce_key(job.data)
+            with self.condition:
+                shared = self.inflight.get(key)
+                if shared is None:
+                    self.inflight[key] = SharedReply()
+                    self.read_jobs.append(dataclasses.replace(job, shared=self.inflight[key]))
+                    self.condition.notify_all()
+                    return
+            job.join(shared)
+            return
+        with self.condition:
+            key = job.data.get("key", "")
+            if key not in self.write_jobs:
+                self.write_jobs[key] = collections.deque()
+                self.write_keys.append(key)
+            self.write_jobs[key].append(job)
+            self.condition.notify_all()
+
+    def next_job(self, lane: str) -> Job | None:
+        if lane == "read":
+            return self.read_jobs.popleft() if self.read_jobs else None
+        if not self.write_keys:
+            return None
+        key = self.write_keys.popleft()
+        jobs = self.write_jobs[key]
+        job = jobs.popleft()
+        if jobs:
+            self.write_keys.append(key)
+        else:
+            del self.write_jobs[key]
+        return job
+
+    def work(self, lane: str):
+        while True:
+            with self.condition:
+                while (job := self.next_job(lane)) is None:
+                    self.condition.wait()
+                self.running[lane] += 1
+            try:
+                job.run()
+            except Exception as e:
+                # The worker keeps going whatever the job did
+                print(f"{type(e).__name__}: {e.__str__()}", file=sys.stderr)
+            finally:
+                with self.condition:
+                    if job.shared is not None:
+                        self.inflight.pop(coalesce_key(job.data), None)
+                    self.running[lane] -= 1
+                    self.condition.notify_all()
+
+    def wait_idle(self):
+        with self.condition:
+            while self.receiving or self.read_jobs or self.write_keys or any(self.running.values()):
+                self.condition.wait()
+
+    def status(self) -> dict:
+        with self.condition:
+            return {
+                "read": {
+                    "queued": len(self.read_jobs),
+                    "running": self.running["read"],
+                    "workers": self.workers["read"],
+                    "inflight": len(self.inflight)
+                },
+                "write": {
+                    "queued": sum(len(jobs) for jobs in self.write_jobs.values()),
+                    "running": self.running["write"],
+                    "workers": self.workers["write"],
+                    "queued_per_key": {key: len(jobs) for key, jobs in self.write_jobs.items()}
+                }
+            }
+
+
+def read_send_fifo(recv_fifo_path: str) -> dict:
+    fd = os.open(recv_fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+    chunks = []
+    received = 0
+    try:
+        while True:
+            ready, _, _ = select.select([fd], [], [], send_fifo_timeout)
+            if not ready:
+                raise TimeoutError(f"Client did not write to '{recv_fifo_path}'")
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            received += len(chunk)
+            if received > request_max_size:
+                raise ValueError(f"Request in '{recv_fifo_path}' is over {request_max_size} bytes")
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    data = json.loads(b"".join(chunks).decode('utf-8'))
+    if not isinstance(data, dict) or not isinstance(data.get("fifo"), str):
+        raise ValueError(f"Request in '{recv_fifo_path}' must be an object with 'fifo'")
+    return data
+
+
+@contextlib.contextmanager
+def open_fifo_reply(fifo_path: str, gid: int):
+    os.mkfifo(fifo_path, 0o640)
+    os.chown(fifo_path, 0, gid)
+    try:
+        with open(fifo_path, "wb") as fifo:
+            yield Reply(fifo)
+    finally:
+        os.remove(fifo_path)
+
+
+def receive_queue(recv_fifo_path: str) -> Job | None:
+    if not os.path.exists(recv_fifo_path):
+        return None
+    path_gid = os.stat(recv_fifo_path).st_gid
+    data = read_send_fifo(recv_fifo_path)
+    return Job(data, functools.partial(open_fifo_reply, data["fifo"], path_gid))
+
+
+def peer_uid(conn: socket.socket) -> int:
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+@contextlib.contextmanager
+def open_connection_reply(conn: socket.socket):
+    with conn, conn.makefile("wb") as conn_writer:
+        yield Reply(conn_writer)
+
+
+def receive_connection(conn: socket.socket) -> Job | None:
+    # Same rule as the queue, only root and the owner of `/tmp/run-deploy.path` may send requests
+    if peer_uid(conn) not in (0, os.stat("/tmp/run-deploy.path").st_uid):
+        with open_connection_reply(conn) as reply:
+            root_fail(reply, 100, "Has no permission")
+        return None
+    job = None
+    stdin = None
+    try:
+        conn.settimeout(send_fifo_timeout)
+        # A `deploy-stream` client sends its stdin along with the start of the frame
+        header, fds, _, _ = socket.recv_fds(conn, 4, 1)
+        stdin = fds[0] if fds else None
+        with conn.makefile("rb") as conn_reader:
+            data = read_frame(conn_reader, header, request_max_size)
+        conn.settimeout(None)
+        if data is None:
+            return None
+        if not isinstance(data, dict):
+            raise ValueError("Request must be a JSON object")
+        if not str(data.get("cmd", "")).startswith("deploy-stream") and stdin is not None:
+            os.close(stdin)
+            stdin = None
+        job = Job(data, functools.partial(open_connection_reply, conn), stdin=stdin)
+        return job
+    except ValueError as e:
+        # Bad JSON or frame, the client still hears why
+        with contextlib.suppress(OSError), open_connection_reply(conn) as reply:
+            root_fail(reply, 1, f"Invalid request: {e.__str__()}")
+        return None
+    finally:
+        if job is None:
+            if stdin is not None:
+                os.close(stdin)
+            conn.close()
+
+
+def listen_socket() -> socket.socket:
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    # Access is checked per connection with SO_PEERCRED
+    os.chmod(socket_path, 0o666)
+    server.listen(socket_backlog)
+    return server
+
+
+def serve_socket(server: socket.socket, dispatcher: Dispatcher):
+    while True:
+        conn, _ = server.accept()
+        dispatcher.receive(functools.partial(receive_connection, conn))
+
+
+def claim_queue(queue: str) -> str | None:
+    # Claim by rename, so `recv` and `serve` never pick up the same request
+    claimed = f"{queue}.claimed"
+    try:
+        os.rename(queue, claimed)
+    except FileNotFoundError:
+        return None
+    fifo_path = pathlib.Path(claimed).read_text('utf-8').strip()
+    os.remove(claimed)
+    return fifo_path
+
+
+def dispatch_queue(dispatcher: Dispatcher, queue: str):
+    fifo_path = claim_queue(queue)
+    if fifo_path:
+        dispatcher.receive(functools.partial(receive_queue, fifo_path))
+
+
+def option_concurrency(name: str, default: int) -> int:
+    try:
+        concurrency = int(pathlib.Path(f"/opt/run-deploy/options/{name}").read_text('utf-8').strip())
+        return max(1, concurrency)
+    except (OSError, ValueError):
+        return default
+
+
+def create_dispatcher() -> Dispatcher:
+    return Dispatcher(
+        read_workers=option_concurrency("socket-read-concurrency", default_read_concurrency),
+        write_workers=option_concurrency("socket-concurrency", default_concurrency)
+    )
+
+
+def must_be_root(cmd: str):
     if getpass.getuser() != "root":
-        print("Must be root to run `recv`", file=sys.stderr)
+        print(f"Must be root to run `{cmd}`", file=sys.stderr)
         exit(1)
-    for queue in pathlib.Path("/tmp/run-deploy-queue").glob("run-deploy-*-queue"):
-        fifo_path = pathlib.Path(str(queue)).read_text('utf-8').strip()
-        os.remove(str(queue))
-        try:
-            process_queue(fifo_path)
-        except KeyError as e:
-            print(e.__str__(), file=sys.stderr)
+
+
+def recv():
+    must_be_root("recv")
+    start_cli_forker()
+    dispatcher = create_dispatcher()
+    # Keep going until the queue is drained, requests can land while we are busy
+    while queues := sorted(pathlib.Path(queue_dir).glob(queue_pattern)):
+        for queue in queues:
+            dispatch_queue(dispatcher, str(queue))
+        dispatcher.wait_idle()
 
 
 commands["recv"] = recv
 
-try:
-    commands[arg_cmd]()
-except KeyError:
-    print("Could not find command", file=sys.stderr)
+
+def serve():
+    must_be_root("serve")
+    start_cli_forker()
+    try:
+        watcher = Inotify.create(queue_dir, IN_CLOSE_WRITE | IN_MOVED_TO)
+    except OSError as e:
+        print(f"Unable to watch '{queue_dir}': {e.__str__()}", file=sys.stderr)
+        exit(1)
+
+    dispatcher = create_dispatcher()
+
+    try:
+        threading.Thread(target=serve_socket, args=(listen_socket(), dispatcher), daemon=True).start()
+    except OSError as e:
+        print(f"Unable to serve '{socket_path}', only the queue is served: {e.__str__()}", file=sys.stderr)
+
+    # Pick up anything queued before the watch was in place
+    for queue in sorted(pathlib.Path(queue_dir).glob(queue_pattern)):
+        dispatch_queue(dispatcher, str(queue))
+
+    while True:
+        for name, mask in watcher.read_events():
+            if mask & IN_IGNORED:
+                # Queue directory is gone, let systemd restart us once it is recreated
+                print(f"'{queue_dir}' was removed", file=sys.stderr)
+                dispatcher.wait_idle()
+                exit(1)
+            if mask & IN_Q_OVERFLOW:
+                for queue in sorted(pathlib.Path(queue_dir).glob(queue_pattern)):
+                    dispatch_queue(dispatcher, str(queue))
+                continue
+            if fnmatch.fnmatch(name, queue_pattern):
+                dispatch_queue(dispatcher, f"{queue_dir}/{name}")
+
+
+commands["serve"] = serve
+
+if __name__ == "__main__":
+    try:
+        commands[sys.argv[1]]()
+    except KeyError:
+        print("Could not find command", file=sys.stderr)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# Read-only squashfs 4.0 reader, run-deploy takes `_deploy` out of an image with it instead of mounting the image.
+# Only what that needs: directories and regular files, compressed with gzip, xz or zstd. Anything else raises
+# `SquashfsError` and run-deploy falls back to squashfuse.
+import dataclasses
+import lzma
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Callable, Iterator, Self
+
+squashfs_magic = 0x73717368
+superblock_size = 96
+
+# Uncompressed size of a metadata block, the inode and directory tables are made of these
+metadata_block_size = 8192
+metadata_uncompressed = 0x8000
+
+# Set in the size of a data block or fragment stored uncompressed
+data_uncompressed = 1 << 24
+
+# Fragment index of a file whose tail is in its last block instead
+no_fragment = 0xFFFFFFFF
+
+# Fragment table entries per metadata block
+fragments_per_block = metadata_block_size // 16
+
+inode_dir = 1
+inode_file = 2
+inode_ext_dir = 8
+inode_ext_file = 9
+
+
+class SquashfsError(Exception):
+    pass
+
+
+def bounded(create: Callable[[], Any]) -> Callable[[bytes, int], bytes]:
+    # Never more than one byte past `limit` comes out, a block whose stream goes on is over the limit,
+    # one whose stream ends early is cut short
+    def decompress(data: bytes, limit: int) -> bytes:
+        stream = create()
+        result = stream.decompress(data, limit + 1)
+        if not stream.eof and len(result) <= limit:
+            raise SquashfsError("Corrupt block: stream ends early")
+        return result
+
+    return decompress
+
+
+def zstd_decompressor() -> tuple[Callable[[bytes, int], bytes], type]:
+    try:
+        # Python 3.14
+        from compression import zstd
+        return bounded(zstd.ZstdDecompressor), zstd.ZstdError
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return lambda data, limit: zstandard.ZstdDecompressor().decompress(data, max_output_size=limit), \
+            zstandard.ZstdError
+    except ImportError:
+        raise SquashfsError("zstd needs Python 3.14 or the zstandard module")
+
+
+def decompressor(compression_id: int) -> Callable[[bytes, int], bytes]:
+    match compression_id:
+        case 1:
+            decompress, error = bounded(zlib.decompressobj), zlib.error
+        case 4:
+            decompress, error = bounded(lambda: lzma.LZMADecompressor(format=lzma.FORMAT_XZ)), lzma.LZMAError
+        case 6:
+            decompress, error = zstd_decompressor()
+        case _:
+            raise SquashfsError(f"Compression {compression_id} is not supported")
+
+    def checked(data: bytes, limit: int) -> bytes:
+        try:
+            result = decompress(data, limit)
+        except error as e:
+            raise SquashfsError(f"Corrupt block: {e}")
+        if len(result) > limit:
+            raise SquashfsError(f"Corrupt block: more than {limit} bytes")
+        return result
+
+    return checked
+
+
+@dataclass(frozen=True)
+class Superblock:
+    block_size: int
+    fragment_count: int
+    compression: int
+    root_inode: int
+    inode_table: int
+    directory_table: int
+    fragment_table: int
+
+    @classmethod
+    def create(cls, data: bytes) -> Self:
+        if len(data) < superblock_size:
+            raise SquashfsError("Not a squashfs image")
+        (magic, _, _, block_size, fragment_count, compression, _, _, _, major, minor, root_inode,
+         _, _, _, inode_table, directory_table, fragment_table, _) = struct.unpack("<5I6H8Q", data[:superblock_size])
+        if magic != squashfs_magic or (major, minor) != (4, 0):
+            raise SquashfsError("Not a squashfs 4.0 image")
+        return cls(
+            block_size=block_size,
+            fragment_count=fragment_count,
+            compression=compression,
+            root_inode=root_inode,
+            inode_table=inode_table,
+            directory_table=directory_table,
+            fragment_table=fragment_table
+        )
+
+
+@dataclass(frozen=True)
+class Inode:
+    type: int
+    mode: int
+    mtime: int
+    # Directories, where their entries are in the directory table
+    listing_block: int = 0
+    listing_offset: int = 0
+    listing_size: int = 0
+    # Files
+    file_size: int = 0
+    blocks_start: int = 0
+    block_sizes: tuple = ()
+    fragment: int = no_fragment
+    fragment_offset: int = 0
+
+    def is_dir(self) -> bool:
+        return self.type in (inode_dir, inode_ext_dir)
+
+    def is_file(self) -> bool:
+        return self.type in (inode_file, inode_ext_file)
+
+
+@dataclass
+class Squashfs:
+    file: BinaryIO
+    superblock: Superblock
+    decompress: Callable[[bytes, int], bytes]
+    # Uncompressed metadata blocks and where the next one starts, keyed by their position in the image
+    metadata_blocks: dict = dataclasses.field(default_factory=dict)
+    # Uncompressed fragment blocks by index, small files share them
+    fragments: dict = dataclasses.field(default_factory=dict)
+    # Bytes of the image read so far, the superblock included
+    bytes_read: int = superblock_size
+
+    @classmethod
+    def create(cls, path: str) -> Self:
+        file = open(path, "rb")
+        try:
+            superblock = Superblock.create(file.read(superblock_size))
+            return cls(file, superblock, decompressor(superblock.compression))
+        except SquashfsError:
+            file.close()
+            raise
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    def read_at(self, position: int, size: int) -> bytes:
+        try:
+            self.file.seek(position)
+            data = self.file.read(size)
+        except (OSError, ValueError, OverflowError):
+            raise SquashfsError(f"Can't read {size} bytes at {position}")
+        if len(data) != size:
+            raise SquashfsError("Image is truncated")
+        self.bytes_read += size
+        return data
+
+    def metadata_block(self, position: int) -> tuple[bytes, int]:
+        if position not in self.metadata_blocks:
+            (header,) = struct.unpack("<H", self.read_at(position, 2))
+            size = header & ~metadata_uncompressed
+            data = self.read_at(position + 2, size)
+            if not header & metadata_uncompressed:
+                data = self.decompress(data, metadata_block_size)
+            self.metadata_blocks[position] = data, position + 2 + size
+        return self.metadata_blocks[position]
+
+    def metadata(self, position: int, offset: int, size: int) -> tuple[bytes, int, int]:
+        # `size` bytes from `offset` into the metadata block at `position`, running on into the blocks after it.
+        # Also where the bytes after them start, as position and offset.
+        chunks = []
+        while size > 0:
+            block, next_position = self.metadata_block(position)
+            if offset > len(block):
+                raise SquashfsError("Metadata offset is out of its block")
+            chunk = block[offset:offset + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            offset += len(chunk)
+            if offset == len(block):
+                position, offset = next_position, 0
+        return b"".join(chunks), position, offset
+
+    def inode(self, ref: int) -> Inode:
+        # A ref is the metadata block (relative to the inode table) and the offset into it
+        position = self.superblock.inode_table + (ref >> 16)
+        header, position, offset = self.metadata(position, ref & 0xFFFF, 16)
+        inode_type, mode, _, _, mtime, _ = struct.unpack("<4H2I", header)
+        match inode_type:
+            case 1:
+                data, _, _ = self.metadata(position, offset, 16)
+                block, _, size, listing_offset, _ = struct.unpack("<2I2HI", data)
+                # The size counts 3 bytes more than the entries take
+                return Inode(inode_type, mode, mtime, block, listing_offset, size - 3)
+            case 8:
+                data, _, _ = self.metadata(position, offset, 24)
+                _, size, block, _, _, listing_offset, _ = struct.unpack("<4I2HI", data)
+                return Inode(inode_type, mode, mtime, block, listing_offset, size - 3)
+            case 2:
+                data, position, offset = self.metadata(position, offset, 16)
+                blocks_start, fragment, fragment_offset, file_size = struct.unpack("<4I", data)
+            case 9:
+                data, position, offset = self.metadata(position, offset, 40)
+                blocks_start, file_size, _, _, fragment, fragment_offset, _ = struct.unpack("<3Q4I", data)
+            case _:
+                raise SquashfsError(f"Inode type {inode_type} is not supported")
+        # The tail of the file is either a block of its own or in a fragment
+        count = file_size // self.superblock.block_size
+        if fragment == no_fragment:
+            count = -(-file_size // self.superblock.block_size)
+        data, _, _ = self.metadata(position, offset, 4 * count)
+        return Inode(
+            type=inode_type,
+            mode=mode,
+            mtime=mtime,
+            file_size=file_size,
+            blocks_start=blocks_start,
+            block_sizes=struct.unpack(f"<{count}I", data),
+            fragment=fragment,
+            fragment_offset=fragment_offset
+        )
+
+    def listdir(self, inode: Inode) -> dict[str, int]:
+        # Names in a directory and the refs of their inodes
+        position = self.superblock.directory_table + inode.listing_block
+        data, _, _ = self.metadata(position, inode.listing_offset, inode.listing_size)
+        entries = {}
+        i = 0
+        while i < len(data):
+            count, start, _ = struct.unpack_from("<3I", data, i)
+            i += 12
+            for _ in range(count + 1):
+                offset, _, _, name_size = struct.unpack_from("<Hh2H", data, i)
+                name = data[i + 8:i + 9 + name_size].decode('utf-8')
+                i += 9 + name_size
+                # Entries end up as paths on the host
+                if name in ("", ".", "..") or "/" in name or "\0" in name:
+                    raise SquashfsError(f"Invalid name '{name}' in the image")
+                entries[name] = (start << 16) | offset
+        return entries
+
+    def lookup(self, path: str) -> Inode | None:
+        inode = self.inode(self.superblock.root_inode)
+        for name in path.strip("/").split("/"):
+            if not inode.is_dir():
+                return None
+            ref = self.listdir(inode).get(name)
+            if ref is None:
+                return None
+            inode = self.inode(ref)
+        return inode
+
+    def fragment(self, index: int) -> bytes:
+        if index not in self.fragments:
+            if index >= self.superblock.fragment_count:
+                raise SquashfsError(f"Fragment {index} is not in the image")
+            # The fragment table is a list of where its metadata blocks are
+            (position,) = struct.unpack(
+                "<Q", self.read_at(self.superblock.fragment_table + 8 * (index // fragments_per_block), 8)
+            )
+            data, _, _ = self.metadata(position, 16 * (index % fragments_per_block), 16)
+            start, size, _ = struct.unpack("<Q2I", data)
+            data = self.read_at(start, size & ~data_uncompressed)
+            if not size & data_uncompressed:
+                data = self.decompress(data, self.superblock.block_size)
+            self.fragments[index] = data
+        return self.fragments[index]
+
+    def read_file(self, inode: Inode) -> Iterator[bytes]:
+        position = inode.blocks_start
+        remaining = inode.file_size
+        for size in inode.block_sizes:
+            expected = min(self.superblock.block_size, remaining)
+            stored = size & ~data_uncompressed
+            if stored == 0:
+                # Sparse, the block is all zeros
+                data = bytes(expected)
+            else:
+                data = self.read_at(position, stored)
+                if not size & data_uncompressed:
+                    data = self.decompress(data, self.superblock.block_size)
+                position += stored
+            if len(data) < expected:
+                raise SquashfsError("Data block is short")
+            remaining -= expected
+            yield data[:expected]
+        if remaining:
+            if inode.fragment == no_fragment:
+                raise SquashfsError("File is missing its fragment")
+            data = self.fragment(inode.fragment)[inode.fragment_offset:inode.fragment_offset + remaining]
+            if len(data) < remaining:
+                raise SquashfsError("Fragment is short")
+            yield data
+
+    def extract(self, inode: Inode, target: str):
+        # Like `shutil.copytree` out of the mounted image, `target` must not exist yet. Root extracts, so no setuid,
+        # setgid or sticky bits.
+        os.mkdir(target)
+        for name, ref in self.listdir(inode).items():
+            child = self.inode(ref)
+            path = os.path.join(target, name)
+            if child.is_dir():
+                self.extract(child, path)
+                continue
+            if not child.is_file():
+                raise SquashfsError(f"'{name}' is neither a file nor a directory")
+            with open(path, "xb") as f:
+                for data in self.read_file(child):
+                    f.write(data)
+            os.chmod(path, child.mode & 0o777)
+            os.utime(path, (child.mtime, child.mtime))
+        os.chmod(target, inode.mode & 0o777)
+        os.utime(target, (inode.mtime, inode.mtime))
+
+
+def extract_dir(image_path: str, path: str, target: str) -> int | None:
+    # `path` in the image copied to `target` and the bytes of the image that took, None when the image has no such
+    # directory
+    with Squashfs.create(image_path) as image:
+        try:
+            inode = image.lookup(path)
+            if inode is None or not inode.is_dir():
+                return None
+            image.extract(inode, target)
+        except (struct.error, UnicodeDecodeError, RecursionError) as e:
+            raise SquashfsError(f"Corrupt image: {e}")
+        return image.bytes_read
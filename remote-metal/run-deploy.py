@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
+import atexit
+import base64
 import datetime
+import fcntl
 import getpass
+import importlib.machinery
 import json
 import os.path
 import pathlib
 import shutil
 import socket
 import string
+import struct
 import subprocess
 import sys
-import time
+import tempfile
 import tomllib
+import types
 from dataclasses import dataclass
 from typing import Self
 
@@ -31,13 +37,20 @@ def validate_key_ref(value: str):
 
 base_dir = ""
 image_name = ""
+# Put the image in place without executing it, prints the revision for `run-deploy-cli revert` to activate
+stage = False
 minisign_public_key_path = ""
+# Streamed in by `run-deploy-socket deploy-stream`, which checked the signature while the bytes arrived
+verified = False
 try:
     target_path = sys.argv[1].strip()
     key_ref = sys.argv[2].strip()
     validate_key_ref(key_ref)
+    stage = "--stage" in sys.argv[3:]
 
     base_dir = os.path.dirname(target_path)
+    # Only for images in the root-only stream directory, the socket is the one writing there
+    verified = "--verified" in sys.argv[3:] and os.path.dirname(os.path.realpath(base_dir)) == "/opt/run-deploy/stream"
     image_name = os.path.basename(target_path)
     minisign_public_key_path = f"/opt/run-deploy/minisign/{key_ref}.pub"
 except IndexError:
@@ -69,79 +82,51 @@ if not image_name.endswith(".squashfs"):
 
 os.chdir(base_dir)
 
-try:
-    subprocess.run(["minisign", "-Vqm", image_name, "-p", minisign_public_key_path], check=True)
-    os.remove(f"{image_name}.minisig")
-except subprocess.CalledProcessError:
-    os.remove(image_name)
-    os.remove(f"{image_name}.minisig")
-    error_and_exit(
-        "INVALID_SIGNATURE_AUTH",
-        f"Invalid signature for '{image_name}'"
-    )
-
-mnt_point = f"/tmp/run-deploy-mount-{time.time()}"
-os.mkdir(mnt_point, 0o700)
-
-try:
-    subprocess.run(["squashfuse", image_name, mnt_point], check=True)
-except subprocess.CalledProcessError:
-    os.remove(image_name)
-    os.rmdir(mnt_point)
-    error_and_exit(
-        "MOUNT",
-        f"Unable to mount '{image_name}'!"
-    )
-
-if not os.path.exists(f"{mnt_point}/_deploy/push.json"):
-    subprocess.run(["umount", mnt_point])
+# Bytes of the image read by this deploy, printed at the end to show it was read once
+image_bytes_read = 0
+
+# Written by run-deploy-image-toml after the end of the filesystem: the manifest as json, its length (>I) and this
+manifest_trailer_magic = b"RDMANIF1"
+# Bytes kept from the end of the image to check the trailer against `_deploy/push.json`
+manifest_trailer_max = 1024 * 1024
+
+
+def parse_manifest_trailer(data: bytes) -> dict | None:
+    # From the last bytes of the image, None when the image was built without one
+    if len(data) < 12 or data[-8:] != manifest_trailer_magic:
+        return None
+    (size,) = struct.unpack(">I", data[-12:-8])
+    if size > len(data) - 12:
+        return None
+    try:
+        manifest = json.loads(data[-12 - size:-12].decode('utf-8'))
+    except ValueError:
+        return None
+    return manifest if isinstance(manifest, dict) else None
+
+
+def read_manifest_trailer() -> dict | None:
+    # The manifest without opening the image
+    global image_bytes_read
+    try:
+        with open(image_name, "rb") as f:
+            f.seek(-12, os.SEEK_END)
+            footer = f.read(12)
+            (size,) = struct.unpack(">I", footer[:4])
+            if footer[-8:] != manifest_trailer_magic or size > manifest_trailer_max:
+                return None
+            f.seek(-12 - size, os.SEEK_END)
+            data = f.read(size) + footer
+    except (OSError, struct.error):
+        return None
+    image_bytes_read += len(data)
+    return parse_manifest_trailer(data)
+
+
+def reject_early(error_name: str, message: str):
     os.remove(image_name)
-    os.rmdir(mnt_point)
-    error_and_exit(
-        "MANIFEST_NOT_EXIST",
-        "'_deploy/push.json' does not exist"
-    )
-
-shutil.copytree(f"{mnt_point}/_deploy", image_name.removesuffix('.squashfs'))
-subprocess.run(["umount", mnt_point])
-if getpass.getuser() == "root":
-    os.chown(image_name, 0, 0)
-shutil.move(image_name, f"{image_name.removesuffix('.squashfs')}/{image_name}")
-
-os.chdir(image_name.removesuffix('.squashfs'))
-
-image_dir = ""
-to_exec = ""
-stamp = False
-try:
-    data = {}
-    with open("push.json", "r", encoding='utf-8') as f:
-        data = json.load(f)
-
-    data = data[socket.gethostname()]
-    image_dir = data['image-dir'].strip()
-    to_exec = data['exec'].strip()
-    stamp = data.get("stamp", False)
-except (KeyError, json.JSONDecodeError):
-    os.chdir('..')
-    shutil.rmtree(f"{image_name.removesuffix('.squashfs')}")
-    os.rmdir(mnt_point)
-    error_and_exit(
-        "MANIFEST_JSON",
-        "Manifest is not well-formed!"
-    )
-
-# Sanity check
-file_name_validation(to_exec, "to_exec")
-file_name_validation(image_dir, "image_dir", True)
-
-cleanup_dir = f"{image_name.removesuffix('.squashfs')}"
-
-
-def clean_up():
-    os.chdir('..')
-    shutil.rmtree(cleanup_dir)
-    os.rmdir(mnt_point)
+    pathlib.Path(f"{image_name}.minisig").unlink(missing_ok=True)
+    error_and_exit(error_name, message)
 
 
 @dataclass(frozen=True)
@@ -197,8 +182,253 @@ class Permission:
             )
 
 
+
+# Image dir the trailer names, the image can be copied into it while minisign checks it
+trailer_image_dir = ""
+
+
+def check_manifest_trailer():
+    # Turn a deploy this server would refuse anyway away before minisign reads the whole image and it is unpacked.
+    # The trailer isn't verified yet so it only ever rejects, `_deploy/push.json` decides once the signature checks out.
+    global image_dir, trailer_image_dir
+    manifest = read_manifest_trailer()
+    if manifest is None:
+        return
+    try:
+        image_dir = manifest[socket.gethostname()]['image-dir'].strip()
+    except (KeyError, AttributeError, TypeError):
+        reject_early(
+            "MANIFEST_JSON",
+            "Manifest is not well-formed!"
+        )
+    file_name_validation(image_dir, "image_dir", True)
+    if not Permission.create().full:
+        reject_early(
+            "PERMISSION",
+            f"You don't have full permission for deploy.( image: {image_dir} )"
+        )
+    trailer_image_dir = image_dir
+
+
+check_manifest_trailer()
+
+signature_path = os.path.abspath(f"{image_name}.minisig")
+def verify_signature():
+    global image_bytes_read
+    try:
+        subprocess.run(["minisign", "-Vqm", image_name, "-x", signature_path, "-p", minisign_public_key_path], check=True)
+        os.remove(signature_path)
+    except subprocess.CalledProcessError:
+        reject_early(
+            "INVALID_SIGNATURE_AUTH",
+            f"Invalid signature for '{image_name}'"
+        )
+    image_bytes_read += os.path.getsize(image_name)
+
+
+def minisig_prehashed() -> bool:
+    # minisign reads the file of a prehashed (`ED`) signature front to back, so it can check it from a pipe. The legacy
+    # `Ed` needs the whole file.
+    try:
+        return base64.b64decode(pathlib.Path(signature_path).read_text('utf-8').splitlines()[1])[:2] == b"ED"
+    except (OSError, IndexError, ValueError):
+        return False
+
+
+# Image bytes read and handed on at a time
+ingest_chunk_size = 1024 * 1024
+
+# Copy of the image in its image dir, made when the upload is on another filesystem, renamed into place by `move_image`
+# and deleted again when the deploy ends before that
+copied_path = ""
+copied_dir = ""
+
+
+def discard_copy():
+    if copied_path:
+        pathlib.Path(copied_path).unlink(missing_ok=True)
+
+
+atexit.register(discard_copy)
+
+
+def on_other_filesystem() -> bool:
+    os.makedirs("/opt/run-deploy/image", exist_ok=True)
+    return os.stat(image_name).st_dev != os.stat("/opt/run-deploy/image").st_dev
+
+
+def copy_image(verify: bool) -> bool:
+    # Into a temporary file of the image dir, with `verify` minisign gets the same chunks. False when the signature
+    # doesn't check out.
+    global image_bytes_read, copied_path, copied_dir
+    print(f"'{base_dir}' is on another filesystem than '/opt/run-deploy/image', copying the image instead of renaming "
+          f"it, upload to the staging dir to avoid that")
+    copied_dir = image_dir
+    os.makedirs(f"/opt/run-deploy/image/{copied_dir}", exist_ok=True)
+    temp_fd, copied_path = tempfile.mkstemp(prefix=f".{image_name}-", dir=f"/opt/run-deploy/image/{copied_dir}")
+    minisign = None
+    if verify:
+        minisign = subprocess.Popen(
+            ["minisign", "-Vqm", "/dev/stdin", "-x", signature_path, "-p", minisign_public_key_path],
+            stdin=subprocess.PIPE
+        )
+    feeding = minisign is not None
+    with open(image_name, "rb") as f, os.fdopen(temp_fd, "wb") as out:
+        while chunk := f.read(ingest_chunk_size):
+            image_bytes_read += len(chunk)
+            out.write(chunk)
+            if feeding:
+                try:
+                    minisign.stdin.write(chunk)
+                except BrokenPipeError:
+                    # Gave up early, its exit code says why
+                    feeding = False
+    shutil.copystat(image_name, copied_path)
+    if getpass.getuser() == "root":
+        os.chown(copied_path, 0, 0)
+    if minisign is None:
+        return True
+    try:
+        minisign.stdin.close()
+    except BrokenPipeError:
+        pass
+    return minisign.wait() == 0
+
+
+# Before anything is taken out of the image, root unpacks `_deploy` and runs what is in it. Streamed images were checked
+# by the socket while they arrived. When the image has to be copied anyway, the trailer says where to and the signature
+# is prehashed, minisign checks it on the way, a single read, and the copy is thrown away when it doesn't check out.
+if not verified and trailer_image_dir and minisig_prehashed() and on_other_filesystem():
+    if not copy_image(verify=True):
+        discard_copy()
+        reject_early(
+            "INVALID_SIGNATURE_AUTH",
+            f"Invalid signature for '{image_name}'"
+        )
+    os.remove(signature_path)
+elif not verified:
+    verify_signature()
+
+mnt_point = tempfile.mkdtemp(prefix="run-deploy-mount-")
+
+
+def extract_deploy_dir() -> bool:
+    # `_deploy` read straight out of the image, False when the built-in reader can't and squashfuse has to mount it
+    if os.path.exists("/opt/run-deploy/options/squashfuse"):
+        return False
+    reader_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "run-deploy-squashfs")
+    if not os.path.exists(reader_path):
+        # Not installed, next to the source
+        reader_path += ".py"
+    try:
+        loader = importlib.machinery.SourceFileLoader("run_deploy_squashfs", reader_path)
+        squashfs = types.ModuleType(loader.name)
+        loader.exec_module(squashfs)
+    except OSError:
+        return False
+    global image_bytes_read
+    deploy_dir = image_name.removesuffix('.squashfs')
+    try:
+        read = squashfs.extract_dir(image_name, "_deploy", deploy_dir)
+    except squashfs.SquashfsError:
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        return False
+    image_bytes_read += read or 0
+    if read is None or not os.path.exists(f"{deploy_dir}/push.json"):
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        os.remove(image_name)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MANIFEST_NOT_EXIST",
+            "'_deploy/push.json' does not exist"
+        )
+    return True
+
+
+if not extract_deploy_dir():
+    try:
+        subprocess.run(["squashfuse", image_name, mnt_point], check=True)
+    except subprocess.CalledProcessError:
+        os.remove(image_name)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MOUNT",
+            f"Unable to mount '{image_name}'!"
+        )
+
+    if not os.path.exists(f"{mnt_point}/_deploy/push.json"):
+        subprocess.run(["umount", mnt_point])
+        os.remove(image_name)
+        os.rmdir(mnt_point)
+        error_and_exit(
+            "MANIFEST_NOT_EXIST",
+            "'_deploy/push.json' does not exist"
+        )
+
+    shutil.copytree(f"{mnt_point}/_deploy", image_name.removesuffix('.squashfs'))
+    subprocess.run(["umount", mnt_point])
+
+if getpass.getuser() == "root":
+    os.chown(image_name, 0, 0)
+shutil.move(image_name, f"{image_name.removesuffix('.squashfs')}/{image_name}")
+
+os.chdir(image_name.removesuffix('.squashfs'))
+
+image_dir = ""
+to_exec = ""
+stamp = False
+try:
+    data = {}
+    with open("push.json", "r", encoding='utf-8') as f:
+        data = json.load(f)
+
+    data = data[socket.gethostname()]
+    image_dir = data['image-dir'].strip()
+    to_exec = data['exec'].strip()
+    stamp = data.get("stamp", False)
+except (KeyError, json.JSONDecodeError):
+    os.chdir('..')
+    shutil.rmtree(f"{image_name.removesuffix('.squashfs')}")
+    os.rmdir(mnt_point)
+    error_and_exit(
+        "MANIFEST_JSON",
+        "Manifest is not well-formed!"
+    )
+
+# Sanity check
+file_name_validation(to_exec, "to_exec")
+file_name_validation(image_dir, "image_dir", True)
+
+cleanup_dir = f"{image_name.removesuffix('.squashfs')}"
+
+
+def clean_up():
+    os.chdir('..')
+    shutil.rmtree(cleanup_dir)
+    os.rmdir(mnt_point)
+
+
+# The image was copied by what the trailer said, which the signature covers, `_deploy/push.json` must say the same
+if copied_path and image_dir != copied_dir:
+    clean_up()
+    error_and_exit(
+        "MANIFEST_JSON",
+        "'_deploy/push.json' does not match the manifest trailer"
+    )
+
+
+def lock_target(name: str) -> int:
+    os.makedirs("/opt/run-deploy/lock", exist_ok=True)
+    lock_fd = os.open(f"/opt/run-deploy/lock/{name}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    return lock_fd
+
+
 Permission.create().must_be_full()
 
+# Deploys and reverts to the same image dir take turns, so the symlink swap stays safe
+target_lock = lock_target(f"metal.{image_dir}")
+
 os.makedirs(f"/opt/run-deploy/image/{image_dir}", exist_ok=True)
 
 # Strict Mode
@@ -224,8 +454,26 @@ if not os.path.exists(to_exec):
         f"'{to_exec}' does not exist"
     )
 
+def move_image():
+    # A rename when the image dir is on the same filesystem, a copy otherwise, unless it was copied while minisign
+    # checked it
+    global copied_path
+    destination = f"/opt/run-deploy/image/{image_dir}/{image_name}"
+    image_size = os.path.getsize(image_name)
+    if not copied_path and os.stat(image_name).st_dev == os.stat(os.path.dirname(destination)).st_dev:
+        os.rename(image_name, destination)
+    else:
+        if not copied_path:
+            copy_image(verify=False)
+        os.rename(copied_path, destination)
+        copied_path = ""
+        os.remove(image_name)
+
+    print(f"Read {image_bytes_read} bytes for the {image_size} byte image ({image_bytes_read / image_size:.2f} passes)")
+
+
 # Move Image to location
-shutil.move(image_name, f"/opt/run-deploy/image/{image_dir}/{image_name}")
+move_image()
 
 # Copy Exec (Enforce name convention)
 if getpass.getuser() == "root":
@@ -237,6 +485,10 @@ pathlib.Path(f"/opt/run-deploy/image/{image_dir}/{image_name.removesuffix('.squa
                                                                                                            'utf-8')
 clean_up()
 
+if stage:
+    print(image_name.removesuffix('.squashfs'))
+    exit(0)
+
 # Exec
 try:
     subprocess.run([
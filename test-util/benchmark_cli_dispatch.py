@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import argparse
+import importlib.util
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description="Compare run-deploy-cli per call cost as a subprocess against in-process dispatch")
+parser.add_argument("--rounds", default=20, help="The amount of cli calls per method")
+parser.add_argument("--edition", default="remote-incus", help="Edition whose cli is called: remote-incus, remote-metal")
+parser.add_argument("--command", default="edition", help="The cli command to call")
+
+args = parser.parse_args()
+
+arg_rounds = int(args.rounds)
+arg_edition = args.edition
+arg_command = args.command
+
+root_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+socket_path = os.path.join(root_path, "remote-incus/run-deploy-socket.py")
+cli_path = os.path.join(root_path, arg_edition, "run-deploy-cli.py")
+socket_spec = importlib.util.spec_from_file_location("run_deploy_socket", socket_path)
+run_deploy_socket = importlib.util.module_from_spec(socket_spec)
+socket_spec.loader.exec_module(run_deploy_socket)
+
+
+class CollectReply:
+    def __init__(self):
+        self.frames = []
+
+    def send(self, data: dict):
+        self.frames.append(data)
+
+
+# Stand-in for minisign so the numbers are only the dispatch, both methods still go through the token check
+stub_bin = tempfile.mkdtemp(prefix="run-deploy-benchmark-")
+with open(f"{stub_bin}/minisign", "w") as f:
+    f.write("#!/bin/sh\nexit 0\n")
+os.chmod(f"{stub_bin}/minisign", 0o755)
+os.environ["PATH"] = f"{stub_bin}:{os.environ['PATH']}"
+os.makedirs("/tmp/run-deploy", exist_ok=True)
+
+
+def create_token() -> dict:
+    token_ref = f"benchmark{time.time_ns()}"
+    for path in [f"/tmp/run-deploy/run-deploy-token-{token_ref}", f"/tmp/run-deploy/run-deploy-token-{token_ref}.minisig"]:
+        with open(path, "w") as f:
+            f.write(token_ref)
+    return {"RUN_DEPLOY_TOKEN": token_ref, "RUN_DEPLOY_KEY": "benchmark"}
+
+
+def subprocess_dispatch(reply: CollectReply, env: dict):
+    run_deploy_socket.handle_subprocess(reply, [sys.executable, cli_path, arg_command], env)
+
+
+def in_process_dispatch(reply: CollectReply, env: dict):
+    run_deploy_socket.handle_cli(reply, cli_path, [arg_command], env)
+
+
+def measure(dispatch) -> list:
+    latencies = []
+    for _ in range(arg_rounds):
+        reply = CollectReply()
+        env = create_token()
+        start = time.perf_counter()
+        dispatch(reply, env)
+        latencies.append(time.perf_counter() - start)
+        if reply.frames[-1] != {"code": 0}:
+            print(f"Call failed: {reply.frames}", file=sys.stderr)
+            sys.exit(1)
+    return latencies
+
+
+# Loaded once up front, like the helper of the daemon does on the first request, then the helper is started with it
+run_deploy_socket.load_cli(cli_path)
+run_deploy_socket.start_cli_forker()
+
+for name, dispatch in [("subprocess", subprocess_dispatch), ("in-process", in_process_dispatch)]:
+    latencies = measure(dispatch)
+    print(
+        f"{name}: mean {statistics.mean(latencies) * 1000:.2f} ms, "
+        f"max {max(latencies) * 1000:.2f} ms over {arg_rounds} rounds"
+    )
+
+os.remove(f"{stub_bin}/minisign")
+os.rmdir(stub_bin)
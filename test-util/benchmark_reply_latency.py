@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import argparse
+import importlib.machinery
+import json
+import os
+import statistics
+import time
+
+parser = argparse.ArgumentParser(description="Compare reply fifo latency of 1 second polling against inotify waiting")
+parser.add_argument("--rounds", default=20, help="The amount of stub requests per method")
+parser.add_argument("--handler-delay", default=0.05, help="Seconds the stub handler takes before replying")
+
+args = parser.parse_args()
+
+arg_rounds = int(args.rounds)
+arg_handler_delay = float(args.handler_delay)
+
+socket_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../remote-incus/run-deploy-socket.py")
+run_deploy_socket = importlib.machinery.SourceFileLoader("run_deploy_socket", socket_path).load_module()
+
+
+def poll_wait_for_fifo(fifo_path: str):
+    while not os.access(fifo_path, os.R_OK):
+        time.sleep(1)
+
+
+def stub_handler(fifo_path: str):
+    # Runs in a forked child, standing in for root answering the request
+    time.sleep(arg_handler_delay)
+    os.mkfifo(fifo_path, 0o640)
+    with open(fifo_path, "w") as fifo:
+        json.dump({"code": 0, "stdout": "", "stderr": ""}, fifo)
+    os.remove(fifo_path)
+    os._exit(0)
+
+
+def measure(wait) -> list:
+    latencies = []
+    for _ in range(arg_rounds):
+        fifo_path = f"/tmp/run-deploy-benchmark-fifo-{time.time()}"
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            stub_handler(fifo_path)
+        wait(fifo_path)
+        with open(fifo_path, "r") as fifo:
+            json.load(fifo)
+        latencies.append(time.perf_counter() - start - arg_handler_delay)
+        os.waitpid(pid, 0)
+    return latencies
+
+
+for name, wait in [("polling", poll_wait_for_fifo), ("inotify", run_deploy_socket.wait_for_fifo)]:
+    latencies = measure(wait)
+    print(
+        f"{name}: mean {statistics.mean(latencies) * 1000:.2f} ms, "
+        f"max {max(latencies) * 1000:.2f} ms over {arg_rounds} rounds"
+    )
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import argparse
+import importlib.machinery
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+parser = argparse.ArgumentParser(description="Compare taking `_deploy` out of an image with squashfuse against the built-in squashfs reader")
+parser.add_argument("--rounds", default=10, help="The amount of extractions per method")
+parser.add_argument("--files", default=10000, help="The amount of files in the image outside of `_deploy`")
+parser.add_argument("--deploy-files", default=10, help="The amount of files in `_deploy`")
+parser.add_argument("--image", default="", help="Use this image instead of building one, it must have `_deploy`")
+
+args = parser.parse_args()
+
+arg_rounds = int(args.rounds)
+arg_files = int(args.files)
+arg_deploy_files = int(args.deploy_files)
+arg_image = args.image
+
+reader_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../remote-metal/run-deploy-squashfs.py")
+loader = importlib.machinery.SourceFileLoader("run_deploy_squashfs", reader_path)
+run_deploy_squashfs = types.ModuleType(loader.name)
+loader.exec_module(run_deploy_squashfs)
+
+work_dir = tempfile.mkdtemp(prefix="run-deploy-benchmark-")
+
+
+def build_image() -> str:
+    # Same options as run-deploy-image-toml
+    source = f"{work_dir}/source"
+    os.makedirs(f"{source}/_deploy")
+    os.makedirs(f"{source}/data")
+    with open(f"{source}/_deploy/push.json", "w") as f:
+        f.write("{}")
+    for i in range(arg_deploy_files):
+        with open(f"{source}/_deploy/file-{i}", "wb") as f:
+            f.write(os.urandom(i * 1000))
+    for i in range(arg_files):
+        with open(f"{source}/data/file-{i}", "wb") as f:
+            f.write(os.urandom(i % 8192))
+    image = f"{work_dir}/benchmark.squashfs"
+    subprocess.run(["mksquashfs", source, image, "-all-root", "-comp", "zstd"], check=True, capture_output=True)
+    shutil.rmtree(source)
+    return image
+
+
+def squashfuse_extract(image: str, target: str):
+    # What run-deploy does without the reader
+    mnt_point = tempfile.mkdtemp(prefix="run-deploy-mount-", dir=work_dir)
+    subprocess.run(["squashfuse", image, mnt_point], check=True)
+    shutil.copytree(f"{mnt_point}/_deploy", target)
+    subprocess.run(["umount", mnt_point], check=True)
+    os.rmdir(mnt_point)
+
+
+def reader_extract(image: str, target: str):
+    if run_deploy_squashfs.extract_dir(image, "_deploy", target) is None:
+        print("The image has no `_deploy`", file=sys.stderr)
+        sys.exit(1)
+
+
+def measure(extract, image: str) -> list:
+    latencies = []
+    for _ in range(arg_rounds):
+        target = f"{work_dir}/_deploy"
+        start = time.perf_counter()
+        extract(image, target)
+        latencies.append(time.perf_counter() - start)
+        shutil.rmtree(target)
+    return latencies
+
+
+if not arg_image and not shutil.which("mksquashfs"):
+    print("mksquashfs is needed to build the image, or pass one with `--image`", file=sys.stderr)
+    sys.exit(1)
+benchmark_image = arg_image or build_image()
+
+methods = [("reader", reader_extract)]
+if shutil.which("squashfuse"):
+    methods.insert(0, ("squashfuse", squashfuse_extract))
+else:
+    print("squashfuse is not installed, only the reader is measured", file=sys.stderr)
+
+try:
+    for name, extract in methods:
+        latencies = measure(extract, benchmark_image)
+        print(
+            f"{name}: mean {statistics.mean(latencies) * 1000:.2f} ms, "
+            f"max {max(latencies) * 1000:.2f} ms over {arg_rounds} rounds"
+        )
+except run_deploy_squashfs.SquashfsError as e:
+    print(f"The reader can't read the image: {e}", file=sys.stderr)
+    sys.exit(1)
+finally:
+    shutil.rmtree(work_dir)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description="Deploy through the run-deploy-socket dispatcher, to two containers at once and twice to the same one, and check the locks of run-deploy let the first overlap and keep the second apart")
+parser.add_argument("--deploy-seconds", default=2, help="Seconds the stub run-deploy holds the lock")
+parser.add_argument("--workers", default=4, help="Write workers of the dispatcher, like `socket-concurrency`")
+
+args = parser.parse_args()
+
+arg_deploy_seconds = float(args.deploy_seconds)
+arg_workers = int(args.workers)
+
+root_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+socket_path = os.path.join(root_path, "remote-incus/run-deploy-socket.py")
+run_deploy_path = os.path.join(root_path, "remote-incus/run-deploy.py")
+socket_spec = importlib.util.spec_from_file_location("run_deploy_socket", socket_path)
+run_deploy_socket = importlib.util.module_from_spec(socket_spec)
+socket_spec.loader.exec_module(run_deploy_socket)
+
+# Stand-in for run-deploy. run-deploy does the whole deploy as soon as it is loaded, so only its `lock_target` is taken
+# out of it and called with the lock name it uses, the lock files are the real ones in `/opt/run-deploy/lock`.
+work_dir = tempfile.mkdtemp(prefix="run-deploy-test-")
+image_dir = f"run-deploy-test-{os.getpid()}"
+stub_deploy = f"{work_dir}/run-deploy"
+with open(stub_deploy, "w") as f:
+    f.write(f"""#!{sys.executable}
+import ast
+import fcntl
+import os
+import sys
+import time
+
+with open({run_deploy_path!r}, "r") as f:
+    tree = ast.parse(f.read(), {run_deploy_path!r})
+lock_target_def = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == "lock_target"]
+namespace = {{"os": os, "fcntl": fcntl}}
+exec(compile(ast.Module(lock_target_def, []), {run_deploy_path!r}, "exec"), namespace)
+
+target, incus_name = sys.argv[1], sys.argv[4]
+lock_fd = namespace["lock_target"](f"incus.{{incus_name}}.{image_dir}")
+start = time.time()
+time.sleep({arg_deploy_seconds})
+end = time.time()
+os.close(lock_fd)
+print(incus_name, start, end)
+""")
+os.chmod(stub_deploy, 0o755)
+
+real_handle_subprocess = run_deploy_socket.handle_subprocess
+
+
+def stub_handle_subprocess(reply, args: list, env=None, stdin_data=None):
+    real_handle_subprocess(reply, [stub_deploy] + args[1:], env, stdin_data)
+
+
+run_deploy_socket.handle_subprocess = stub_handle_subprocess
+
+
+class CollectReply:
+    def __init__(self):
+        self.frames = []
+        self.done = threading.Event()
+
+    def send(self, data: dict):
+        self.frames.append(data)
+        if "code" in data:
+            self.done.set()
+
+    def stdout(self) -> str:
+        return "".join(frame.get("stdout", "") for frame in self.frames)
+
+
+def deploy_job(incus_name: str, key: str, reply: CollectReply) -> run_deploy_socket.Job:
+    return run_deploy_socket.Job(
+        data={"cmd": "deploy", "target": f"/tmp/run-deploy/{incus_name}.squashfs", "key": key, "incus": [incus_name]},
+        open_reply=lambda: contextlib.nullcontext(reply)
+    )
+
+
+def run_case(title: str, deploys: list[tuple[str, str]], overlap: bool) -> bool:
+    # Each deploy is (container, minisign key), different keys so only the lock can keep them apart
+    dispatcher = run_deploy_socket.Dispatcher(read_workers=1, write_workers=arg_workers)
+    replies = [CollectReply() for _ in deploys]
+    start = time.perf_counter()
+    for (incus_name, key), reply in zip(deploys, replies):
+        dispatcher.submit(deploy_job(incus_name, key, reply))
+    for reply in replies:
+        reply.done.wait(arg_deploy_seconds * 10)
+    total = time.perf_counter() - start
+
+    ok = True
+    held = []
+    for (incus_name, key), reply in zip(deploys, replies):
+        if reply.frames[-1:] != [{"code": 0}]:
+            print(f"{title}: {incus_name} ({key}) did not complete {reply.frames}", file=sys.stderr)
+            ok = False
+            continue
+        _, lock_start, lock_end = reply.stdout().split()
+        held.append((float(lock_start), float(lock_end)))
+        print(f"{title}: {incus_name} ({key}) held the lock for {float(lock_end) - float(lock_start):.2f}s")
+    print(f"{title}: total {total:.2f}s for {len(deploys)} deploys of {arg_deploy_seconds:.2f}s each")
+
+    if len(held) == 2:
+        (start_1, end_1), (start_2, end_2) = held
+        if overlap and not (start_1 < end_2 and start_2 < end_1):
+            print(f"{title}: the deploys ran one after another", file=sys.stderr)
+            ok = False
+        if not overlap and start_1 < end_2 and start_2 < end_1:
+            print(f"{title}: the deploys ran at the same time", file=sys.stderr)
+            ok = False
+    return ok
+
+
+failed = False
+for title, deploys, overlap in [
+    ("different containers", [("container-1", "key-1"), ("container-2", "key-2")], True),
+    ("same container", [("container-1", "key-1"), ("container-1", "key-2")], False)
+]:
+    if not run_case(title, deploys, overlap):
+        failed = True
+
+shutil.rmtree(work_dir)
+for incus_name in ["container-1", "container-2"]:
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(f"/opt/run-deploy/lock/incus.{incus_name}.{image_dir}.lock")
+sys.exit(1 if failed else 0)
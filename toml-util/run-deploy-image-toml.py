@@ -6,6 +6,7 @@ import os.path
 import pathlib
 import shutil
 import string
+import struct
 import subprocess
 import sys
 import time
@@ -62,7 +63,8 @@ class BuildDataError(Exception): pass
 
 @dataclass()
 class ManifestData:
-    incus_name: str = ""
+    # A list when several containers on the host share the image, it is then uploaded and verified once for all
+    incus_name: str|list[str] = ""
     image_dir: str = ""
     exec: str = ""
     stamp: float = 0
@@ -70,7 +72,12 @@ class ManifestData:
     @classmethod
     def create(cls, data: dict) -> Self:
         incus_name = incus_name = data.get("incus-name", "")
-        if incus_name:
+        if isinstance(incus_name, list):
+            for name in incus_name:
+                if not isinstance(name, str):
+                    raise ManifestDataError("'incus-name' must be a str or a list of str")
+                file_name_validation(name, "incus-name", True)
+        elif incus_name:
             file_name_validation(incus_name, "incus-name", True)
         return cls(incus_name)
 
@@ -96,6 +103,8 @@ class BuildData:
     build_script: str
     manifest: dict[str, ManifestData]
     tmp_locaiton: str = "/tmp"
+    delta: bool = False
+    compression: str = "zstd"
 
     @classmethod
     def create(cls, data: dict) -> Self:
@@ -116,11 +125,21 @@ class BuildData:
         name = data["name"]
         file_name_validation(name, "name", True)
 
+        delta = data.get("delta", False)
+        if not isinstance(delta, bool):
+            raise BuildDataError("'delta' must be a bool")
+
+        compression = data.get("compression", "zstd")
+        if compression not in ["gzip", "lzo", "lz4", "xz", "zstd"]:
+            raise BuildDataError("'compression' must be one of gzip, lzo, lz4, xz or zstd")
+
         return cls(
             name=name,
             build_script=os.path.abspath(data["build_script"]),
             manifest=manifest,
-            tmp_locaiton=data.get("tmp_location", "/tmp")
+            tmp_locaiton=data.get("tmp_location", "/tmp"),
+            delta=delta,
+            compression=compression
         )
 
     def make_manifest_json_dict(self) -> dict:
@@ -191,9 +210,21 @@ except PermissionError:
         "Does not have permission to run `build_script`"
     )
 
+squashfs_options = []
+if build_data.delta:
+    # Small files aren't packed together into shared fragment blocks, a changed file then leaves the blocks of the
+    # files around it alone and rsync finds more of the last image to reuse
+    squashfs_options += ["-no-fragments"]
+
 subprocess.run([
-    "mksquashfs", "mnt", squashfs_name, "-all-root", "-comp", "zstd"
-], check=True, capture_output=True)
+    "mksquashfs", "mnt", squashfs_name, "-all-root", "-comp", build_data.compression
+] + squashfs_options, check=True, capture_output=True)
 shutil.rmtree("mnt")
 
+# The manifest again after the end of the filesystem, so run-deploy can turn a deploy away without opening the image.
+# squashfs ignores what comes after it, and minisign signs the whole file, trailer included.
+manifest_trailer = json.dumps(build_data.make_manifest_json_dict()).encode('utf-8')
+with open(squashfs_name, "ab") as f:
+    f.write(manifest_trailer + struct.pack(">I", len(manifest_trailer)) + b"RDMANIF1")
+
 print(os.path.realpath(squashfs_name))
@@ -1,17 +1,29 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
+import base64
+import concurrent.futures
+import contextlib
+import dataclasses
+import functools
 import getpass
+import hashlib
 import json
+import math
 import os
 import pathlib
 import shutil
 import socket
 import string
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import tomllib
 from dataclasses import dataclass
-from typing import Self
+from typing import Any, Callable, Self
 
 
 def error_and_exit(error_name: str, message: str):
@@ -54,6 +66,11 @@ parser.add_argument("--list-revision", action='store_true')
 parser.add_argument("--last-deploy", action='store_true')
 parser.add_argument("--last-deploy-blame", action='store_true')
 parser.add_argument("--revert", metavar="REVISION")
+parser.add_argument("--jobs", type=int, help="Hosts worked on at the same time, overrides `max_parallel`")
+parser.add_argument("--pipeline", action='store_true', help="Every host goes upload, stage, activate on its own")
+parser.add_argument("--barrier", action='store_true', help="With --pipeline, activate only once every host has staged")
+parser.add_argument("--canary", help="Hosts (or percentage like `10%%`) in the first wave, overrides `canary`")
+parser.add_argument("--wave-size", type=int, help="Hosts in every wave after the canary, overrides `wave_size`")
 
 args = parser.parse_args()
 
@@ -65,6 +82,13 @@ flag_list_revision = args.list_revision
 flag_last_deploy = args.last_deploy
 flag_last_deploy_blame = args.last_deploy_blame
 flag_revert = args.revert
+flag_jobs = args.jobs
+flag_pipeline = args.pipeline
+flag_barrier = args.barrier
+flag_canary = args.canary
+flag_wave_size = args.wave_size
+if flag_jobs is not None and flag_jobs < 1:
+    error_and_exit("JOBS", "'--jobs' must be at least 1")
 
 
 def image_args() -> list:
@@ -97,6 +121,12 @@ class MinisignPasswd:
             return None
         return self.passwd.encode('utf-8')
 
+    def passwdLine(self) -> bytes:
+        # For when more follows on stdin, the cli only takes the first line as the password
+        if not self.passwd:
+            return b""
+        return self.passwd.encode('utf-8') + b"\n"
+
     def environment(self) -> dict:
         d = {}
         if self.passwd:
@@ -122,6 +152,23 @@ os.chdir(os.path.dirname(os.path.abspath(arg_toml)))
 class DeployDataError(Exception): pass
 
 
+def canary_hosts(value: Any, host_count: int) -> int:
+    # Either a number of hosts or a percentage of them as a string (`"10%"`), at least one host when it is a percentage
+    if isinstance(value, str) and value.endswith("%"):
+        try:
+            percent = float(value.removesuffix("%"))
+        except ValueError:
+            raise DeployDataError("'canary' must be a number of hosts or a percentage like \"10%\"")
+        if not 0 < percent <= 100:
+            raise DeployDataError("'canary' percentage must be above 0 and at most 100")
+        return max(1, math.ceil(host_count * percent / 100))
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise DeployDataError("'canary' must be a number of hosts or a percentage like \"10%\"")
+    return value
+
+
 class SSHConfigError(Exception): pass
 
 
@@ -129,7 +176,8 @@ class SSHConfigError(Exception): pass
 class SSHConfig:
     incus_name: str
     is_metal: bool
-    upload: str = "/tmp/run-deploy"
+    # Empty until preflight says where the server wants it, see `upload_dirs`
+    upload: str = ""
 
     @classmethod
     def create(cls, data: dict) -> Self:
@@ -138,17 +186,106 @@ class SSHConfig:
             file_name_validation(incus_name, "incus", True)
         return cls(
             incus_name=incus_name,
-            upload=data.get("upload", "/tmp/run-deploy"),
+            upload=data.get("upload", ""),
             is_metal=data.get("metal", False)
         )
 
 
+@dataclass(frozen=True)
+class SSHMultiplex:
+    # Directory holding one control socket per target, None when multiplexing is off
+    control_dir: str|None = None
+    persist: int = 300
+    # One lock per control socket, aliases of the same machine share it and so must not start a master each
+    locks: dict = dataclasses.field(default_factory=dict, compare=False)
+    locks_guard: threading.Lock = dataclasses.field(default_factory=threading.Lock, compare=False)
+
+    @classmethod
+    def create(cls, data: dict) -> Self:
+        enabled = data.get("multiplex", True)
+        persist = data.get("multiplex_persist", 300)
+        if not isinstance(enabled, bool):
+            raise DeployDataError("'multiplex' must be a bool")
+        if not isinstance(persist, int) or isinstance(persist, bool) or persist < 1:
+            raise DeployDataError("'multiplex_persist' must be a positive int")
+        if not enabled:
+            return cls(persist=persist)
+        return cls(control_dir=tempfile.mkdtemp(prefix="run-deploy-ssh-"), persist=persist)
+
+    def control_path(self) -> str:
+        return f"{self.control_dir}/%C"
+
+    def connect(self, ssh_address: str):
+        # Opened up front rather than by `ControlMaster=auto`, so the master never holds on to a captured stderr.
+        # Checked every time, the master may have timed out while the image was building.
+        if not self.control_dir:
+            return
+        with self.lock(ssh_address):
+            if subprocess.run([
+                "ssh", "-o", f"ControlPath={self.control_path()}", "-O", "check", ssh_address
+            ], capture_output=True).returncode == 0:
+                return
+            subprocess.run([
+                "ssh", "-f", "-N",
+                "-o", "ControlMaster=yes",
+                "-o", f"ControlPath={self.control_path()}",
+                "-o", f"ControlPersist={self.persist}",
+                ssh_address
+            ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+    def lock(self, ssh_address: str) -> threading.Lock:
+        # `%C` as ssh expands it, falls back to the address when ssh can't tell
+        process = subprocess.run([
+            "ssh", "-G", "-o", f"ControlPath={self.control_path()}", ssh_address
+        ], capture_output=True)
+        config = dict(line.split(" ", 1) for line in process.stdout.decode('utf-8').splitlines() if " " in line)
+        key = config.get("controlpath", ssh_address) if process.returncode == 0 else ssh_address
+        with self.locks_guard:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def options(self, ssh_address: str) -> list:
+        if not self.control_dir:
+            return []
+        self.connect(ssh_address)
+        # Without a master it is a plain connection, same as with multiplexing off
+        return ["-o", f"ControlPath={self.control_path()}", "-o", "ControlMaster=no"]
+
+    def environment(self, ssh_address: str) -> dict:
+        # Picked up by run-deploy-remote-cli, so its scp and ssh go through the same connection
+        if not self.control_dir:
+            return {}
+        self.connect(ssh_address)
+        return {"RUN_DEPLOY_SSH_CONTROL_PATH": self.control_path()}
+
+    def close(self, ssh_addresses: list):
+        if not self.control_dir:
+            return
+        for ssh_address in ssh_addresses:
+            subprocess.run([
+                "ssh", "-o", f"ControlPath={self.control_path()}", "-O", "exit", ssh_address
+            ], capture_output=True)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
 @dataclass(frozen=True)
 class DeployData:
     image_name: str
     create_image_script: str
     ssh_configs: dict[str, SSHConfig]
+    multiplex: SSHMultiplex
     pre_script: tuple = ()
+    session_ttl: int = 0
+    max_parallel: int = 1
+    pipeline: bool = False
+    barrier: bool = False
+    canary: int = 0
+    wave_size: int = 0
+    settle: float = 0
+    health_script: str = ""
+    delta: bool = False
+    resumable: bool = False
+    upload_retries: int = 5
+    stream: bool = False
 
     @classmethod
     def create(cls, data: dict) -> Self:
@@ -174,6 +311,58 @@ class DeployData:
             except KeyError:
                 raise SSHConfigError("There isn't a flag set for either `flag_ssh` or `flag_ssh_metal`")
 
+        session_ttl = data.get("session", 0)
+        if not isinstance(session_ttl, int) or isinstance(session_ttl, bool) or session_ttl < 0:
+            raise DeployDataError("'session' must be a number of seconds, 0 to turn it off")
+
+        max_parallel = data.get("max_parallel", 1)
+        if not isinstance(max_parallel, int) or isinstance(max_parallel, bool) or max_parallel < 1:
+            raise DeployDataError("'max_parallel' must be at least 1")
+
+        pipeline = data.get("pipeline", False)
+        barrier = data.get("barrier", False)
+        if not isinstance(pipeline, bool) or not isinstance(barrier, bool):
+            raise DeployDataError("'pipeline' and 'barrier' must be a bool")
+
+        canary = canary_hosts(flag_canary or data.get("canary", 0), len(ssh_configs))
+        wave_size = data.get("wave_size", 0)
+        if flag_wave_size is not None:
+            wave_size = flag_wave_size
+        if not isinstance(wave_size, int) or isinstance(wave_size, bool) or wave_size < 0:
+            raise DeployDataError("'wave_size' must be a number of hosts, 0 for the rest in one wave")
+
+        settle = data.get("settle", 0)
+        if not isinstance(settle, (int, float)) or isinstance(settle, bool) or settle < 0:
+            raise DeployDataError("'settle' must be a number of seconds")
+
+        health_script = data.get("health_script", "")
+        if not isinstance(health_script, str):
+            raise DeployDataError("'health_script' must be a str")
+        if health_script:
+            health_script = os.path.abspath(health_script)
+
+        delta = data.get("delta", False)
+        if not isinstance(delta, bool):
+            raise DeployDataError("'delta' must be a bool")
+        if delta and not shutil.which("rsync"):
+            raise DeployDataError("'delta' needs rsync")
+
+        resumable = data.get("resumable", False)
+        if not isinstance(resumable, bool):
+            raise DeployDataError("'resumable' must be a bool")
+        upload_retries = data.get("upload_retries", 5)
+        if not isinstance(upload_retries, int) or isinstance(upload_retries, bool) or upload_retries < 0:
+            raise DeployDataError("'upload_retries' must be a positive int")
+
+        stream = data.get("stream", False)
+        if not isinstance(stream, bool):
+            raise DeployDataError("'stream' must be a bool")
+        # Both need the image in the upload directory first
+        if stream and (delta or resumable):
+            print(f"'stream' is off, '{'delta' if delta else 'resumable'}' needs the image uploaded first",
+                  file=sys.stderr)
+            stream = False
+
         pre_script = data.get("pre_script", [])
         for key in range(len(pre_script)):
             pre_script[key] = os.path.abspath(pre_script[key])
@@ -182,7 +371,20 @@ class DeployData:
             image_name=image_name,
             create_image_script=os.path.abspath(data["create_image_script"]),
             ssh_configs=ssh_configs,
-            pre_script=tuple(pre_script)
+            multiplex=SSHMultiplex.create(data),
+            pre_script=tuple(pre_script),
+            session_ttl=session_ttl,
+            max_parallel=max_parallel,
+            pipeline=pipeline or flag_pipeline,
+            barrier=barrier or flag_barrier,
+            canary=canary,
+            wave_size=wave_size,
+            settle=settle,
+            health_script=health_script,
+            delta=delta,
+            resumable=resumable,
+            upload_retries=upload_retries,
+            stream=stream
         )
 
 
@@ -198,154 +400,219 @@ if not deploy_data:
 
 toml_manifest = None
 
+atexit.register(deploy_data.multiplex.close, list(deploy_data.ssh_configs.keys()))
+
+
+def cli_environment(ssh_address: str) -> dict:
+    # One signed token per server for the whole run, limited to this image
+    session = {
+        "RUN_DEPLOY_SESSION_TTL": str(deploy_data.session_ttl),
+        "RUN_DEPLOY_SESSION_IMAGE": deploy_data.image_name
+    }
+    return passwd.environment() | deploy_data.multiplex.environment(ssh_address) | session
+
+
 remote_cli = "run-deploy-remote-cli"
 remote_deploy = "deploy"
 
 
 process_error_message = "Did you check that you got the SSH Private Key in the agent? Does `minisign.key` require a password? =D"
 
+# Hosts worked on at the same time in every phase
+jobs = flag_jobs or deploy_data.max_parallel
 
-# List revision
-if flag_list_revision:
+print_lock = threading.Lock()
+host_timing: dict[str, dict[str, float]] = {}
+
+
+class HostSkipped(Exception): pass
+
+
+def print_prefixed(ssh_address: str, text: str, file=sys.stdout):
+    with print_lock:
+        for line in text.splitlines():
+            print(f"[{ssh_address}] {line}", file=file, flush=True)
+
+
+def print_timing():
+    if not host_timing:
+        return
+    print("-- Timing --", file=sys.stderr)
+    for ssh_address in deploy_data.ssh_configs.keys():
+        if ssh_address not in host_timing:
+            continue
+        timing = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in host_timing[ssh_address].items())
+        print(f"[{ssh_address}] {timing}", file=sys.stderr)
+
+
+atexit.register(print_timing)
+
+
+def run_prefixed(ssh_address: str, args: list, show_stdout: bool = True, input: bytes|None = None,
+                 env: dict|None = None, stdin_file=None) -> subprocess.CompletedProcess:
+    # Same as `subprocess.run(check=True, capture_output=True)`, but also prints every line with the host in front
+    process = subprocess.Popen(args, stdin=stdin_file or subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=env)
+    if not stdin_file:
+        if input:
+            process.stdin.write(input)
+        process.stdin.close()
+    output = {"stdout": [], "stderr": []}
+
+    def forward(name: str, file, show: bool):
+        for line in iter(getattr(process, name).readline, b""):
+            output[name].append(line)
+            if show:
+                print_prefixed(ssh_address, line.decode('utf-8', 'replace'), file)
+
+    stderr_thread = threading.Thread(target=forward, args=("stderr", sys.stderr, True))
+    stderr_thread.start()
+    forward("stdout", sys.stdout, show_stdout)
+    stderr_thread.join()
+    code = process.wait()
+    stdout = b"".join(output["stdout"])
+    stderr = b"".join(output["stderr"])
+    if code:
+        raise subprocess.CalledProcessError(code, args, stdout, stderr)
+    return subprocess.CompletedProcess(args, code, stdout, stderr)
+
+
+def run_cli(ssh_address: str, ssh_config: SSHConfig, cli_args: list, show_stdout: bool = True,
+            stdin: bytes = b"") -> subprocess.CompletedProcess:
+    current_remote_cli = remote_cli
+    if ssh_config.is_metal:
+        current_remote_cli = "run-deploy-remote-metal-cli"
+    extra = []
+    if ssh_config.incus_name:
+        extra += ["--incus", ssh_config.incus_name]
+    return run_prefixed(ssh_address, [
+        current_remote_cli, ssh_address
+    ] + cli_args + ["--image", deploy_data.image_name] + extra,
+        show_stdout=show_stdout, input=passwd.passwdLine() + stdin, env=cli_environment(ssh_address))
+
+
+@contextlib.contextmanager
+def record_timing(ssh_address: str, phase: str):
+    start = time.monotonic()
     try:
-        print("-- Listing Revision -- ", file=sys.stderr)
-        for ssh_address, ssh_config in deploy_data.ssh_configs.items():
-            print(f"-- Revision: {ssh_address}", file=sys.stderr)
-            current_remote_cli = remote_cli
-            if ssh_config.is_metal:
-                current_remote_cli = "run-deploy-remote-metal-cli"
-            extra = []
-            if ssh_config.incus_name:
-                extra += ["--incus", ssh_config.incus_name]
-            subprocess.run([
-                current_remote_cli, ssh_address, "list-revision", "--image", deploy_data.image_name
-            ]+extra, check=True, input=passwd.passwdInput(), env=passwd.environment())
-    except subprocess.CalledProcessError as e:
-        print(process_error_message, file=sys.stderr)
-        exit(e.returncode)
+        yield
+    finally:
+        with print_lock:
+            host_timing.setdefault(ssh_address, {})[phase] = time.monotonic() - start
+
+
+def run_hosts(phase: str, run: Callable[[str, SSHConfig], Any], stop_on_failure: bool = False,
+              workers: int|None = None, hosts: dict[str, SSHConfig]|None = None) -> dict:
+    # Runs `run` for every host (or only `hosts`), `jobs` at a time, each result is what it returned or what it raised.
+    # With `stop_on_failure` the hosts that haven't started once one failed are skipped, like the serial loop did.
+    if hosts is None:
+        hosts = deploy_data.ssh_configs
+    failed = threading.Event()
+
+    def timed(ssh_address: str, ssh_config: SSHConfig):
+        if stop_on_failure and failed.is_set():
+            return HostSkipped("Skipped, another host failed")
+        with record_timing(ssh_address, phase):
+            try:
+                return run(ssh_address, ssh_config)
+            except Exception as e:
+                failed.set()
+                return e
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or jobs) as executor:
+        futures = {
+            ssh_address: executor.submit(timed, ssh_address, ssh_config)
+            for ssh_address, ssh_config in hosts.items()
+        }
+    return {ssh_address: future.result() for ssh_address, future in futures.items()}
+
+
+def failures(results: dict) -> dict:
+    return {ssh_address: result for ssh_address, result in results.items() if isinstance(result, Exception)}
 
+
+def failure_code(e: Exception) -> int:
+    return getattr(e, "returncode", 1)
+
+
+def list_hosts(title: str, cli_args: list):
+    print(f"-- {title} -- ", file=sys.stderr)
+    failed = failures(run_hosts(title.lower(), lambda ssh_address, ssh_config: run_cli(ssh_address, ssh_config, cli_args)))
+    for ssh_address, e in failed.items():
+        if not isinstance(e, subprocess.CalledProcessError):
+            print_prefixed(ssh_address, e.__str__(), sys.stderr)
+    if failed:
+        print(process_error_message, file=sys.stderr)
+        exit(failure_code(next(iter(failed.values()))))
     exit(0)
 
 
+# List revision
+if flag_list_revision:
+    list_hosts("Listing Revision", ["list-revision"])
+
+
 # List last deploy
 if flag_last_deploy:
-    try:
-        print("-- Listing Last Deploy -- ", file=sys.stderr)
-        for ssh_address, ssh_config in deploy_data.ssh_configs.items():
-            print(f"-- Last Deploy: {ssh_address}", file=sys.stderr)
-            current_remote_cli = remote_cli
-            if ssh_config.is_metal:
-                current_remote_cli = "run-deploy-remote-metal-cli"
-            extra = []
-            if ssh_config.incus_name:
-                extra += ["--incus", ssh_config.incus_name]
-            subprocess.run([
-                current_remote_cli, ssh_address, "last-deploy", "--image", deploy_data.image_name
-            ]+extra, check=True, input=passwd.passwdInput(), env=passwd.environment())
-    except subprocess.CalledProcessError as e:
-        print(process_error_message, file=sys.stderr)
-        exit(e.returncode)
-
-    exit(0)
+    list_hosts("Listing Last Deploy", ["last-deploy"])
 
 
 # List last deploy blame
 if flag_last_deploy_blame:
-    try:
-        print("-- Listing Last Deploy Blame -- ", file=sys.stderr)
-        for ssh_address, ssh_config in deploy_data.ssh_configs.items():
-            print(f"-- Last Deploy Blame: {ssh_address}", file=sys.stderr)
-            current_remote_cli = remote_cli
-            if ssh_config.is_metal:
-                current_remote_cli = "run-deploy-remote-metal-cli"
-            extra = []
-            if ssh_config.incus_name:
-                extra += ["--incus", ssh_config.incus_name]
-            subprocess.run([
-                current_remote_cli, ssh_address, "last-deploy-blame", "--image", deploy_data.image_name
-            ]+extra, check=True, input=passwd.passwdInput(), env=passwd.environment())
-    except subprocess.CalledProcessError as e:
-        print(process_error_message, file=sys.stderr)
-        exit(e.returncode)
-
-    exit(0)
+    list_hosts("Listing Last Deploy Blame", ["last-deploy-blame"])
 
 
 # Bulk revert
 if flag_revert:
     file_name_validation(flag_revert, "flag_revert", True)
-    try:
-        print("-- Performing Bulk Revert -- ", file=sys.stderr)
-        for ssh_address, ssh_config in deploy_data.ssh_configs.items():
-            print(f"-- Last Deploy Blame: {ssh_address}", file=sys.stderr)
-            current_remote_cli = remote_cli
-            if ssh_config.is_metal:
-                current_remote_cli = "run-deploy-remote-metal-cli"
-            extra = []
-            if ssh_config.incus_name:
-                extra += ["--incus", ssh_config.incus_name]
-            subprocess.run([
-                current_remote_cli, ssh_address, "revert", "--image", deploy_data.image_name, "--revision", flag_revert
-            ]+extra, check=True, input=passwd.passwdInput(), env=passwd.environment())
-    except subprocess.CalledProcessError as e:
+    list_hosts("Performing Bulk Revert", ["revert", "--revision", flag_revert])
+
+
+def check_host(ssh_address: str, ssh_config: SSHConfig) -> dict:
+    # Permission, the revision the host is on now and its free space, in one call
+    upload = ["--upload", ssh_config.upload] if ssh_config.upload else []
+    return json.loads(run_cli(
+        ssh_address, ssh_config, ["preflight"] + upload, show_stdout=False
+    ).stdout.decode('utf-8'))
+
+
+# Every host must pass before anything is uploaded
+print("-- Preflight --", file=sys.stderr)
+fail = False
+preflight: dict[str, dict] = {}
+for ssh_address, result in run_hosts("preflight", check_host).items():
+    if isinstance(result, json.JSONDecodeError):
+        error_and_exit("JSON_PREFLIGHT", "Unable to decode preflight")
+    if isinstance(result, Exception):
+        if not isinstance(result, subprocess.CalledProcessError):
+            print_prefixed(ssh_address, result.__str__(), sys.stderr)
         print(process_error_message, file=sys.stderr)
-        exit(e.returncode)
-
-    exit(0)
-
-
-try:
-    print("-- Checking Permission --", file=sys.stderr)
-    fail = False
-    for ssh_address, ssh_config in deploy_data.ssh_configs.items():
-        print(f"-- Checking {ssh_address} --", file=sys.stderr)
-        current_remote_cli = remote_cli
-        if ssh_config.is_metal:
-            current_remote_cli = "run-deploy-remote-metal-cli"
-        extra = []
-        if ssh_config.incus_name:
-            extra += ["--incus", ssh_config.incus_name]
-        permission_data = subprocess.run([
-            current_remote_cli, ssh_address, "permission-json", "--image", deploy_data.image_name
-        ]+extra, check=True, capture_output=True, input=passwd.passwdInput(), env=passwd.environment()).stdout.decode('utf-8')
-        permission_data = json.loads(permission_data)
-        has_full_permission = permission_data.get("full", False)
-        if has_full_permission:
-            print("Result: OK", file=sys.stderr)
-        else:
-            fail=True
-            print("Result: FAIL", file=sys.stderr)
-    if fail:
-        exit(101)
-except subprocess.CalledProcessError as e:
-    print(e.output.decode('utf-8'), file=sys.stderr)
-    print(process_error_message, file=sys.stderr)
-    exit(e.returncode)
-except json.JSONDecodeError:
-    error_and_exit("JSON_PERMISSION", "Unable to decode permission")
-
-last_deploy = ""
-try:
-    top_ssh_address = str(list(deploy_data.ssh_configs.keys())[0])
-    top_ssh = deploy_data.ssh_configs[top_ssh_address]
-    top_remote_cli = remote_cli
-    if top_ssh.is_metal:
-        top_remote_cli = "run-deploy-remote-metal-cli"
-
-    extra = []
-    if top_ssh.incus_name:
-        extra += ["--incus", top_ssh.incus_name]
-
-    # Get the last deploy
-    last_deploy = subprocess.run([
-        top_remote_cli, top_ssh_address, "last-deploy", "--image", deploy_data.image_name,
-    ]+extra, check=True, capture_output=True, input=passwd.passwdInput(), env=passwd.environment()).stdout.decode('utf-8').strip()
-except subprocess.CalledProcessError as e:
-    print(e.output.decode('utf-8'), file=sys.stderr)
-    exit(e.returncode)
+        exit(failure_code(result))
+    preflight[ssh_address] = result
+    if not result.get("full", False):
+        fail = True
+        print_prefixed(ssh_address, "Permission: FAIL", sys.stderr)
+    elif not result.get("container-exists", True):
+        fail = True
+        print_prefixed(ssh_address, f"Container `{deploy_data.ssh_configs[ssh_address].incus_name}` not found", sys.stderr)
+    else:
+        print_prefixed(ssh_address, "Result: OK", sys.stderr)
+if fail:
+    exit(101)
+
+# Without `upload` the image goes where preflight says, metal servers name a staging directory on the filesystem of their
+# images so it is renamed into place there instead of copied out of /tmp
+for ssh_address, result in preflight.items():
+    if not deploy_data.ssh_configs[ssh_address].upload:
+        deploy_data.ssh_configs[ssh_address] = dataclasses.replace(
+            deploy_data.ssh_configs[ssh_address], upload=result.get("upload", "/tmp/run-deploy")
+        )
 
-if last_deploy:
-    print(f"-- Last deploy is: {last_deploy}", file=sys.stderr)
+# Each host is reverted to its own last deploy
+last_deploys = {ssh_address: result.get("current-revision") or "" for ssh_address, result in preflight.items()}
+for ssh_address, last_deploy in last_deploys.items():
+    if last_deploy:
+        print_prefixed(ssh_address, f"Last deploy is: {last_deploy}", sys.stderr)
 
 # Pre Script
 try:
@@ -385,55 +652,361 @@ except subprocess.CalledProcessError:
         "Unable sign image, does it need a password?"
     )
 
-# Upload image
-try:
-    for ssh_address, ssh_config in deploy_data.ssh_configs.items():
-        print(f"-- Uploading: {ssh_address} --", file=sys.stderr)
-        subprocess.run([
-            "scp", f"{image_name}.minisig", image_name, f"{ssh_address}:{ssh_config.upload}"
-        ], check=True)
-except subprocess.CalledProcessError:
+# Checked against what preflight found, rather than finding out halfway through an upload
+image_size = os.path.getsize(image_name)
+for ssh_address, result in preflight.items():
+    for place, free in result.get("free-space", {}).items():
+        # With delta the upload directory holds the last revision as well while rsync builds the new one
+        needed = image_size * 2 if deploy_data.delta and place == "upload" else image_size
+        if free is not None and free < needed:
+            print_prefixed(ssh_address, f"Not enough space in the {place} directory, {free} bytes free, needs {needed} bytes", sys.stderr)
+            fail = True
+if fail:
+    shutil.rmtree(os.path.dirname(image_name))
     error_and_exit(
-        "IMAGE_UPLOAD",
-        "Failed to upload image"
+        "FREE_SPACE",
+        "Not enough free space on at least one host"
     )
 
 base_image_name = os.path.basename(image_name)
 image_dir = os.path.dirname(image_name)
 
-try:
-    for ssh_address, ssh_config in deploy_data.ssh_configs.items():
-        current_remote_deploy = remote_deploy
-        if ssh_config.is_metal:
-            current_remote_deploy = "deploy-metal"
-        print(f"-- Deploying: {ssh_address} --", file=sys.stderr)
-        process_data = subprocess.run([
-            "ssh", ssh_address, "--", "/opt/run-deploy/bin/run-deploy-socket", current_remote_deploy,
-            f"{ssh_config.upload}/{base_image_name}",
-            f"{key_ref}"
-        ], check=True, capture_output=True)
-        output = process_data.stdout.decode('utf-8').strip()
-        if output:
-            print(output)
-        outerr = process_data.stderr.decode('utf-8').strip()
-        if outerr:
-            print(outerr)
-except subprocess.CalledProcessError as e:
-    outerr = e.stderr.decode('utf-8')
-    print(outerr, file=sys.stderr)
-    if e.returncode != 100 or json.loads(outerr).get("error_name", "") != "EXEC_FAIL":
+
+def upload_delta(ssh_address: str, ssh_config: SSHConfig):
+    # The server copies its current revision to where this one is going, rsync then only sends the blocks that changed
+    try:
+        basis = run_cli(ssh_address, ssh_config, [
+            "delta-basis", "--upload", ssh_config.upload, "--revision", base_image_name.removesuffix('.squashfs')
+        ], show_stdout=False).stdout.decode('utf-8').strip()
+    except subprocess.CalledProcessError:
+        basis = ""
+    if basis:
+        print_prefixed(ssh_address, f"Sending the changes since {basis}", sys.stderr)
+    else:
+        print_prefixed(ssh_address, "Nothing to compare against, sending the whole image", sys.stderr)
+    run_prefixed(ssh_address, [
+        "rsync", "--no-whole-file",
+        "-e", " ".join(["ssh"] + deploy_data.multiplex.options(ssh_address)),
+        f"{image_name}.minisig", image_name, f"{ssh_address}:{ssh_config.upload}/"
+    ])
+
+
+# Bytes sent per chunk by a resumable upload, each with its own checksum
+upload_chunk_size = 4 * 1024 * 1024
+
+
+@functools.cache
+def file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def send_resumable(ssh_address: str, ssh_config: SSHConfig, path: str):
+    # `run-deploy-socket upload` prints how much it already has, only the rest is sent
+    process = subprocess.Popen([
+        "ssh"
+    ] + deploy_data.multiplex.options(ssh_address) + [
+        ssh_address, "--", "/opt/run-deploy/bin/run-deploy-socket", "upload", ssh_config.upload,
+        os.path.basename(path), file_sha256(path), str(os.path.getsize(path))
+    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = []
+    stderr_thread = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    stderr_thread.start()
+    try:
+        offset = int(process.stdout.readline().strip() or -1)
+        if offset >= 0:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                while chunk := f.read(upload_chunk_size):
+                    process.stdin.write(struct.pack(">I", len(chunk)) + hashlib.sha256(chunk).digest() + chunk)
+                process.stdin.write(struct.pack(">I", 0))
+        process.stdin.close()
+    except (BrokenPipeError, ValueError):
+        pass
+    process.stdout.read()
+    code = process.wait()
+    stderr_thread.join()
+    if code:
+        raise subprocess.CalledProcessError(code, process.args, b"", b"".join(stderr))
+
+
+def upload_resumable(ssh_address: str, ssh_config: SSHConfig):
+    for path in [f"{image_name}.minisig", image_name]:
+        for attempt in range(deploy_data.upload_retries + 1):
+            try:
+                send_resumable(ssh_address, ssh_config, path)
+                break
+            except subprocess.CalledProcessError as e:
+                if e.stderr:
+                    print_prefixed(ssh_address, e.stderr.decode('utf-8', 'replace'), sys.stderr)
+                # Only a broken connection (ssh exits 255, the server side dies without its error json) is worth
+                # resuming, an error the server named won't go away by trying again
+                if attempt == deploy_data.upload_retries or (e.returncode != 255 and error_name(e)):
+                    raise
+                wait = min(2 ** attempt, 30)
+                print_prefixed(ssh_address, f"Upload of {os.path.basename(path)} broke off, resuming in {wait}s "
+                                            f"({attempt + 1}/{deploy_data.upload_retries})", sys.stderr)
+                time.sleep(wait)
+
+
+# Upload image
+def upload(ssh_address: str, ssh_config: SSHConfig):
+    if deploy_data.stream:
+        # Sent along with the deploy
+        return
+    upload_image(ssh_address, ssh_config)
+
+
+def upload_image(ssh_address: str, ssh_config: SSHConfig):
+    if deploy_data.delta:
+        upload_delta(ssh_address, ssh_config)
+        return
+    if deploy_data.resumable:
+        upload_resumable(ssh_address, ssh_config)
+        return
+    run_prefixed(ssh_address, [
+        "scp"
+    ] + deploy_data.multiplex.options(ssh_address) + [
+        f"{image_name}.minisig", image_name, f"{ssh_address}:{ssh_config.upload}"
+    ])
+
+
+def deploy(ssh_address: str, ssh_config: SSHConfig, stage: bool = False,
+           members: list[str]|None = None) -> subprocess.CompletedProcess:
+    current_remote_deploy = remote_deploy
+    if ssh_config.is_metal:
+        current_remote_deploy = "deploy-metal"
+    extra = []
+    if stage:
+        extra += ["--stage"]
+    # Several containers of the same machine, deployed from the one upload
+    if members and len(members) > 1 and not ssh_config.is_metal:
+        for member in members:
+            extra += ["--incus", deploy_data.ssh_configs[member].incus_name]
+    if deploy_data.stream:
+        try:
+            return deploy_stream(ssh_address, current_remote_deploy.replace("deploy", "deploy-stream"), extra)
+        except subprocess.CalledProcessError as e:
+            if error_name(e) != "STREAM_UNAVAILABLE":
+                raise
+        print_prefixed(ssh_address, "The server can't take a streamed image, uploading it first", sys.stderr)
+        upload_image(ssh_address, ssh_config)
+    return run_prefixed(ssh_address, [
+        "ssh"
+    ] + deploy_data.multiplex.options(ssh_address) + [
+        ssh_address, "--", "/opt/run-deploy/bin/run-deploy-socket", current_remote_deploy,
+        f"{ssh_config.upload}/{base_image_name}",
+        f"{key_ref}"
+    ] + extra)
+
+
+def deploy_stream(ssh_address: str, remote_command: str, extra: list) -> subprocess.CompletedProcess:
+    # One ssh call, the image goes on its stdin and the server verifies it on the way in
+    with open(f"{image_name}.minisig", "rb") as f:
+        minisig = base64.urlsafe_b64encode(f.read()).decode('utf-8')
+    with open(image_name, "rb") as image:
+        return run_prefixed(ssh_address, [
+            "ssh"
+        ] + deploy_data.multiplex.options(ssh_address) + [
+            ssh_address, "--", "/opt/run-deploy/bin/run-deploy-socket", remote_command,
+            base_image_name, key_ref, str(os.path.getsize(image_name)), minisig
+        ] + extra, stdin_file=image)
+
+
+def error_name(e: Exception) -> str:
+    if not isinstance(e, subprocess.CalledProcessError) or e.returncode != 100:
+        return ""
+    try:
+        stderr = e.stderr.decode('utf-8')
+        # run-deploy ends with the error json, what minisign, incus or the exec script printed comes before it
+        start = stderr.rfind("\n{") + 1
+        return json.loads(stderr[start:]).get("error_name", "")
+    except (json.JSONDecodeError, UnicodeDecodeError, AttributeError):
+        return ""
+
+
+def is_exec_fail(e: Exception) -> bool:
+    return error_name(e) == "EXEC_FAIL"
+
+
+# Pipelined, every host goes upload -> stage (verify and ingest) -> activate on its own. Uploads and server side
+# steps have their own `jobs` slots, so the next host's upload overlaps the ingest of the one before it.
+upload_slots = threading.Semaphore(jobs)
+remote_slots = threading.Semaphore(jobs)
+# With `barrier` no host activates until every host has staged
+activate_barrier = threading.Barrier(len(deploy_data.ssh_configs))
+pipeline_failed = threading.Event()
+# Group members already on the new revision, a later member failing must not keep them from being reverted
+activated: dict[str, SSHConfig] = {}
+
+
+def pipeline_step(ssh_address: str, phase: str, slots: threading.Semaphore, run: Callable[[], Any]) -> Any:
+    if pipeline_failed.is_set():
+        raise HostSkipped("Skipped, another host failed")
+    with slots, record_timing(ssh_address, phase):
+        try:
+            return run()
+        except Exception:
+            pipeline_failed.set()
+            activate_barrier.abort()
+            raise
+
+
+def pipeline_host(ssh_address: str, ssh_config: SSHConfig, members: list[str]):
+    pipeline_step(ssh_address, "upload", upload_slots, lambda: upload(ssh_address, ssh_config))
+    staged = pipeline_step(ssh_address, "stage", remote_slots, lambda: deploy(
+        ssh_address, ssh_config, stage=True, members=members
+    ))
+    revision = staged.stdout.decode('utf-8').strip().splitlines()[-1]
+    if deploy_data.barrier:
+        try:
+            activate_barrier.wait()
+        except threading.BrokenBarrierError:
+            raise HostSkipped("Skipped, another host failed")
+    for member in members:
+        pipeline_step(ssh_address, "activate", remote_slots, lambda: run_cli(
+            member, deploy_data.ssh_configs[member], ["revert", "--revision", revision]
+        ))
+        activated[member] = deploy_data.ssh_configs[member]
+
+
+@functools.cache
+def resolve_host(ssh_address: str) -> tuple:
+    # Where ssh really ends up once `~/.ssh/config` is applied, two addresses for the same machine share an upload
+    process = subprocess.run(["ssh", "-G", ssh_address], capture_output=True)
+    config = dict(line.split(" ", 1) for line in process.stdout.decode('utf-8').splitlines() if " " in line)
+    if process.returncode or "hostname" not in config:
+        return ssh_address,
+    return config.get("user"), config["hostname"], config.get("port")
+
+
+def upload_groups(wave: dict[str, SSHConfig]) -> dict[str, list[str]]:
+    # Hosts of the wave that land in the same upload directory of the same machine, keyed by the first of them
+    groups = {}
+    leaders = {}
+    for ssh_address, ssh_config in wave.items():
+        key = (resolve_host(ssh_address), ssh_config.upload, ssh_config.is_metal)
+        leader = leaders.setdefault(key, ssh_address)
+        groups.setdefault(leader, []).append(ssh_address)
+        if leader != ssh_address:
+            print_prefixed(ssh_address, f"Same machine as {leader}, sharing its upload", sys.stderr)
+    return groups
+
+
+def group_results(results: dict, groups: dict[str, list[str]]) -> dict:
+    # What happened to the first host of a group happened to all of them
+    return {member: results[leader] for leader, members in groups.items() for member in members}
+
+
+def deploy_waves() -> list[dict[str, SSHConfig]]:
+    # The canary first, then `wave_size` hosts at a time, in the order of the toml. One wave of every host by default.
+    addresses = list(deploy_data.ssh_configs.keys())
+    waves = []
+    if deploy_data.canary:
+        waves.append(addresses[:deploy_data.canary])
+        addresses = addresses[deploy_data.canary:]
+    # The canary can take every host, `max` keeps the step of the empty range above 0
+    size = deploy_data.wave_size or max(1, len(addresses))
+    for i in range(0, len(addresses), size):
+        waves.append(addresses[i:i + size])
+    return [{ssh_address: deploy_data.ssh_configs[ssh_address] for ssh_address in wave} for wave in waves]
+
+
+def check_health(ssh_address: str, ssh_config: SSHConfig):
+    run_prefixed(ssh_address, [deploy_data.health_script, ssh_address], env=os.environ | {
+        "RUN_DEPLOY_SSH_ADDRESS": ssh_address,
+        "RUN_DEPLOY_IMAGE": deploy_data.image_name,
+        "RUN_DEPLOY_INCUS": ssh_config.incus_name
+    })
+
+
+def deploy_wave(wave: dict[str, SSHConfig]) -> dict:
+    global activate_barrier
+    groups = upload_groups(wave)
+    leaders = {ssh_address: wave[ssh_address] for ssh_address in groups}
+    if deploy_data.pipeline:
+        print("-- Deploying (pipelined) --", file=sys.stderr)
+        # Only the hosts of this wave wait on each other
+        activate_barrier = threading.Barrier(len(leaders))
+        return group_results(run_hosts("pipeline", lambda ssh_address, ssh_config: pipeline_host(
+            ssh_address, ssh_config, groups[ssh_address]
+        ), workers=len(leaders), hosts=leaders), groups)
+    print("-- Uploading --", file=sys.stderr)
+    if failures(run_hosts("upload", upload, stop_on_failure=True, hosts=leaders)):
+        error_and_exit(
+            "IMAGE_UPLOAD",
+            "Failed to upload image"
+        )
+    print("-- Deploying --", file=sys.stderr)
+    return group_results(run_hosts("deploy", lambda ssh_address, ssh_config: deploy(
+        ssh_address, ssh_config, members=groups[ssh_address]
+    ), stop_on_failure=True, hosts=leaders), groups)
+
+
+def revert_touched(touched: dict[str, SSHConfig]):
+    # Every touched host at once, recovery time shouldn't grow with the fleet
+    print("-- Reverting --", file=sys.stderr)
+    for ssh_address in touched:
+        if not last_deploys[ssh_address]:
+            print_prefixed(ssh_address, "Nothing to revert to, it is the first deploy", sys.stderr)
+    touched = {ssh_address: ssh_config for ssh_address, ssh_config in touched.items() if last_deploys[ssh_address]}
+    revert_results = run_hosts("revert", lambda ssh_address, ssh_config: run_cli(
+        ssh_address, ssh_config, ["revert", "--revision", last_deploys[ssh_address]]
+    ), workers=len(touched), hosts=touched)
+    print("-- Revert Summary --", file=sys.stderr)
+    for ssh_address, result in revert_results.items():
+        seconds = host_timing[ssh_address]["revert"]
+        if isinstance(result, Exception):
+            print_prefixed(ssh_address, f"FAIL ({seconds:.2f}s)", sys.stderr)
+        else:
+            print_prefixed(ssh_address, f"OK, back on {last_deploys[ssh_address]} ({seconds:.2f}s)", sys.stderr)
+    revert_failures = failures(revert_results)
+    if revert_failures:
         shutil.rmtree(image_dir)
-        exit(e.returncode)
-    for ssh_address, ssh_config in deploy_data.ssh_configs.items():
-        current_remote_cli = remote_cli
-        if ssh_config.is_metal:
-            current_remote_cli = "run-deploy-remote-metal-cli"
-        extra = []
-        if ssh_config.incus_name:
-            extra += ["--incus", ssh_config.incus_name]
-        subprocess.run([
-            current_remote_cli, ssh_address, "revert", "--image", deploy_data.image_name, "--revision", last_deploy
-        ]+extra, check=True, input=passwd.passwdInput(), env=passwd.environment())
+        exit(failure_code(next(iter(revert_failures.values()))))
+
+
+waves = deploy_waves()
+# Hosts that got as far as the server side deploy in this run, only those are reverted
+touched: dict[str, SSHConfig] = {}
+for wave_number, wave in enumerate(waves, start=1):
+    if len(waves) > 1:
+        print(f"-- Wave {wave_number}/{len(waves)}: {', '.join(wave.keys())} --", file=sys.stderr)
+    deploy_results = deploy_wave(wave)
+    touched |= {
+        ssh_address: wave[ssh_address] for ssh_address, result in deploy_results.items()
+        if not isinstance(result, Exception) or is_exec_fail(result)
+    } | {ssh_address: wave[ssh_address] for ssh_address in activated if ssh_address in wave}
+    deploy_failures = {
+        ssh_address: e for ssh_address, e in failures(deploy_results).items() if not isinstance(e, HostSkipped)
+    }
+    if deploy_failures:
+        # Any host failing its exec stops the rollout and puts every touched host back on the last deploy. So does any
+        # other failure once a pipelined host of the wave activated the new revision.
+        if not any(is_exec_fail(e) for e in deploy_failures.values()):
+            if any(ssh_address in wave for ssh_address in activated):
+                revert_touched(touched)
+            shutil.rmtree(image_dir)
+            exit(failure_code(next(iter(deploy_failures.values()))))
+        revert_touched(touched)
+        break
+    if deploy_data.settle and (deploy_data.health_script or wave_number < len(waves)):
+        print(f"-- Settling for {deploy_data.settle}s --", file=sys.stderr)
+        time.sleep(deploy_data.settle)
+    if deploy_data.health_script:
+        print("-- Checking Health --", file=sys.stderr)
+        health_failures = failures(run_hosts("health", check_health, hosts=wave))
+        for ssh_address, e in health_failures.items():
+            if not isinstance(e, subprocess.CalledProcessError):
+                print_prefixed(ssh_address, e.__str__(), sys.stderr)
+            print_prefixed(ssh_address, "Health: FAIL", sys.stderr)
+        if health_failures:
+            revert_touched(touched)
+            shutil.rmtree(image_dir)
+            error_and_exit(
+                "HEALTH_CHECK",
+                f"Health check failed on {', '.join(health_failures.keys())}, rollout stopped"
+            )
 
 # Finally remove the image from tmp.
 shutil.rmtree(image_dir)